@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# offline end-to-end benchmark of the crawl and outbox cycles. the niconico pages are
+# replayed from the test fixtures by a local http stub, which the opener reaches as its
+# http proxy, twitter is replaced by a fake tweepy.API, and mongo is the local mongod,
+# or the storage is sqlite with --sqlite.
+#
+#   python benchmarks/bench_e2e.py [--communities N] [--cycles M] [--responses R]
+#
+# every cycle, the bbs pages serve R new responses renumbered from community_bbs.html, and
+# the live, news and video pages are the fixtures as is.
+
+import argparse
+import BaseHTTPServer
+import itertools
+import json
+import os
+import re
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+import nicobbs  # noqa
+
+FIXTURE_DIR = os.path.join(BASE_DIR, "tests")
+RESPONSE_REGEXP = re.compile(r'<dt class="reshead">.*?</dd>', re.DOTALL)
+RESPONSE_NUMBER_REGEXP = re.compile(r'name="(\d+)" class="resnumhead"></a>\d+')
+FIRST_RESPONSE_NUMBER = 1000
+# 1x1 png for the oekaki images
+PNG = ("\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00"
+       "\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N"
+       "\x00\x00\x00\x00IEND\xaeB`\x82")
+
+CONFIG = """\
+[nicobbs]
+mail = bench@example.com
+password = bench
+database_name = %(database_name)s
+storage = %(storage)s
+sqlite_path = %(temp_dir)s/nicobbs.sqlite
+ng_words =
+ng_hash =
+crawl_workers = %(crawl_workers)d
+host_interval = 0
+fetch_workers = %(fetch_workers)d
+cookie_file = %(temp_dir)s/nicobbs.cookie
+tweet_interval = 0
+tweet_burst = 1000000
+tweet_daily_limit = 1000000000
+poll_min_interval = 0
+poll_max_interval = 0
+
+%(communities)s
+[loggers]
+keys=root
+
+[logger_root]
+level=%(log_level)s
+handlers=file
+
+[handlers]
+keys=file
+
+[handler_file]
+class=%(log_class)s
+level=NOTSET
+formatter=%(log_formatter)s
+args=%(log_args)s
+
+[formatters]
+keys=default,json
+
+[formatter_default]
+format=[%%(asctime)s] [%%(levelname)s] [%%(threadName)s] %%(message)s
+datefmt=
+
+[formatter_json]
+class=nicoutil.JSONFormatter
+format=
+datefmt=
+"""
+
+COMMUNITY_CONFIG = """\
+[community-%s]
+consumer_key = xxx
+consumer_secret = xxx
+access_key = xxx
+access_secret = xxx
+
+"""
+
+STAGES = [
+    ("fetch", ["read_response_page", "read_reserved_live_page", "read_video_page"]),
+    ("parse", ["parse_response", "parse_reserved_live", "parse_news", "parse_video"]),
+    ("store", ["store_response", "store_reserved_live", "store_news", "store_video"]),
+    ("tweet", ["update_twitter_status"]),
+    ("crawl_community", ["crawl_community"]),
+    ("post_community", ["post_community"])]
+
+
+def read_fixture(name):
+    f = open(os.path.join(FIXTURE_DIR, name))
+    content = f.read()
+    f.close()
+    return content
+
+
+class Pages(object):
+    # magic methods
+    def __init__(self, responses):
+        self.responses = responses
+        self.cycle = 0
+        self.fixtures = dict([(name, read_fixture(name + ".html")) for name in [
+            "community_bbs", "community_top", "community_video", "channel_live"]])
+
+        # the fixture is split into the head, the responses and the tail
+        bbs = self.fixtures["community_bbs"]
+        blocks = RESPONSE_REGEXP.findall(bbs)
+        self.bbs_head = bbs[:bbs.index(blocks[0])]
+        self.bbs_tail = bbs[bbs.rindex(blocks[-1]) + len(blocks[-1]):]
+        self.bbs_blocks = blocks
+
+    # internal methods
+    def bbs_page(self):
+        first = FIRST_RESPONSE_NUMBER + self.cycle * self.responses
+        blocks = []
+        for index in range(self.responses):
+            number = first + index
+            block = self.bbs_blocks[index % len(self.bbs_blocks)]
+            blocks.append(RESPONSE_NUMBER_REGEXP.sub(
+                'name="%d" class="resnumhead"></a>%d' % (number, number), block))
+        return self.bbs_head + "\n".join(blocks) + self.bbs_tail
+
+    def bbs_top_page(self, community):
+        return ('<iframe src="http://dic.nicovideo.jp/b/c/%s/" width="100%%"></iframe>\n'
+                '<a href="/b/c/%s/?hash_key=1:2:3:4:abcdef">\n' % (community, community))
+
+    # public methods
+    def route(self, url):
+        # returns (route name, body), the body is None for the unknown pages
+        matched = re.match(r'http://([^/]+)(/.*)', url)
+        host, path = matched.groups() if matched else ("", url)
+        if host == "com.nicovideo.jp":
+            if path.startswith("/bbs/"):
+                return "bbs_top", self.bbs_top_page(path.split("/")[2])
+            if path.startswith("/community/"):
+                return "community_top", self.fixtures["community_top"]
+            if path.startswith("/video/"):
+                return "community_video", self.fixtures["community_video"]
+        elif host == "ch.nicovideo.jp":
+            if path.endswith("/bbs"):
+                return "bbs_top", self.bbs_top_page(path.split("/")[1])
+            if path.endswith("/live"):
+                return "channel_live", self.fixtures["channel_live"]
+        elif host == "dic.nicovideo.jp":
+            if path.endswith(".png") or ".png?" in path:
+                return "oekaki", PNG
+            if re.match(r'/b/c/[^/]+/$', path):
+                return "bbs", self.bbs_page()
+            if re.match(r'/b/c/[^/]+/\d+-$', path):
+                return "bbs_gap", self.fixtures["community_bbs"]
+        return "unknown", None
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, code, body, headers={}):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header(nicobbs.nicoutil.AUTHFLAG_HEADER, "1")
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        # login
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.count("login", 0)
+        self.reply(200, "", {"Set-Cookie": "user_session=bench; Domain=.nicovideo.jp; Path=/"})
+
+    def do_GET(self):
+        (name, body) = self.server.pages.route(self.path)
+        if body is None:
+            self.server.count(name, 0)
+            self.reply(404, "")
+            return
+        self.server.count(name, len(body))
+        self.reply(200, body, {"Content-Type": "text/html; charset=utf-8"})
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # magic methods
+    def __init__(self, pages):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.pages = pages
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.bytes = {}
+
+    # public methods
+    def count(self, name, size):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            self.bytes[name] = self.bytes.get(name, 0) + size
+
+
+class FakeStatus(object):
+    def __init__(self, status_id):
+        self.id = status_id
+
+
+class FakeTwitterAPI(object):
+    # stands in for tweepy.API, statuses are counted and dropped after the latency
+    latency = 0
+    lock = threading.Lock()
+    ids = itertools.count(1)
+    statuses = 0
+    media = 0
+
+    def __init__(self, auth=None):
+        self.auth = auth
+
+    def post(self, media=False):
+        if self.latency:
+            time.sleep(self.latency)
+        with FakeTwitterAPI.lock:
+            FakeTwitterAPI.statuses += 1
+            FakeTwitterAPI.media += int(media)
+            return FakeStatus(FakeTwitterAPI.ids.next())
+
+    def update_status(self, status, in_reply_to_status_id=None):
+        return self.post()
+
+    def update_with_media(self, filename, status, in_reply_to_status_id=None):
+        return self.post(True)
+
+
+class Stopwatch(object):
+    # magic methods
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    # public methods
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                with self.lock:
+                    self.samples.setdefault(stage, []).append(elapsed)
+        return timed
+
+    def instrument(self, bbs):
+        for (stage, names) in STAGES:
+            for name in names:
+                setattr(bbs, name, self.wrap(stage, getattr(bbs, name)))
+
+    def summary(self, stage):
+        samples = sorted(self.samples.get(stage, []))
+        if not samples:
+            return None
+        return {"count": len(samples),
+                "total": sum(samples),
+                "mean": sum(samples) / len(samples),
+                "p50": samples[len(samples) / 2],
+                "p95": samples[min(int(len(samples) * 0.95), len(samples) - 1)],
+                "max": samples[-1]}
+
+
+def create_communities(count):
+    # a quarter of them are channels, which have no news and video pages
+    return [("ch%d" if index % 4 == 3 else "co%d") % (index + 1) for index in range(count)]
+
+
+def write_config(path, options, database_name, temp_dir, communities):
+    log_handler = "FileHandler(\"%s/nicobbs.log\", 'w')" % temp_dir
+    if options.async_log:
+        log_class, log_args = "nicoutil.AsyncHandler", "(%s,)" % log_handler
+    else:
+        log_class, log_args = "FileHandler", log_handler[len("FileHandler"):]
+    f = open(path, "w")
+    f.write(CONFIG % {
+        "database_name": database_name,
+        "storage": nicobbs.STORAGE_SQLITE if options.sqlite else nicobbs.STORAGE_MONGO,
+        "crawl_workers": options.crawl_workers,
+        "fetch_workers": options.fetch_workers,
+        "temp_dir": temp_dir,
+        "log_level": options.log_level,
+        "log_class": log_class,
+        "log_args": log_args,
+        "log_formatter": "json" if options.json_log else "default",
+        "communities": "".join([COMMUNITY_CONFIG % community for community in communities])})
+    f.close()
+
+
+def run(options):
+    communities = create_communities(options.communities)
+    pages = Pages(options.responses)
+    server = StubServer(pages)
+    thread = threading.Thread(target=server.serve_forever, name="stub")
+    thread.daemon = True
+    thread.start()
+
+    # the opener reaches the stub as the proxy of the niconico urls, and logs in over http
+    os.environ["http_proxy"] = "http://127.0.0.1:%d" % server.server_port
+    nicobbs.LOGIN_URL = "http://secure.nicovideo.jp/secure/login"
+    nicobbs.tweepy.API = FakeTwitterAPI
+    FakeTwitterAPI.latency = options.tweet_latency
+
+    temp_dir = tempfile.mkdtemp(prefix="nicobbs_bench_")
+    cwd = os.getcwd()
+    os.chdir(temp_dir)
+    os.mkdir("images")
+    database_name = "nicobbs_bench_%d" % os.getpid()
+    config_file = os.path.join(temp_dir, "nicobbs.config")
+    write_config(config_file, options, database_name, temp_dir, communities)
+
+    bbs = nicobbs.NicoBBS(config_file)
+    try:
+        stopwatch = Stopwatch()
+        stopwatch.instrument(bbs)
+
+        # same steps as start(), without the background threads and the sleeps
+        bbs.bootstrap_indexes()
+        bbs.load_pages()
+        bbs.warm_poll_schedule()
+        bbs.warm_seen_keys()
+        pool = ThreadPool(bbs.crawl_workers)
+        opener = bbs.create_opener()
+        bbs.opener = opener
+
+        cycle_seconds = []
+        for cycle in range(options.cycles):
+            pages.cycle = cycle
+            start = time.time()
+            crawl = stopwatch.wrap("crawl_cycle", bbs.crawl_cycle)
+            crawl(pool, opener)
+            outbox = stopwatch.wrap("outbox", bbs.process_outbox)
+            outbox(bbs.active_communities())
+            cycle_seconds.append(time.time() - start)
+        pool.close()
+        bbs.downloader.close()
+
+        return report(options, communities, cycle_seconds, stopwatch, server,
+                      sum_samples(bbs.metrics, "items_registered_total", "kind"),
+                      sum_samples(bbs.metrics, "db_round_trips_total", "stage"))
+    finally:
+        if bbs.connection is not None:
+            bbs.connection.drop_database(database_name)
+        server.shutdown()
+        os.chdir(cwd)
+        if options.keep:
+            print "kept the log and the images in %s" % temp_dir
+        else:
+            shutil.rmtree(temp_dir)
+
+
+def sum_samples(metrics, name, label):
+    # sums the counter of nicobbs by the label, like the mongo round trips by the stage
+    sums = {}
+    samples = metrics.snapshot()["metrics"].get(name, {"samples": []})
+    for sample in samples["samples"]:
+        value = sample["labels"].get(label, "other")
+        sums[value] = sums.get(value, 0) + sample["value"]
+    return sums
+
+
+def report(options, communities, cycle_seconds, stopwatch, server, items, round_trips):
+    total = sum(cycle_seconds)
+    result = {
+        "communities": len(communities),
+        "cycles": len(cycle_seconds),
+        "responses_per_cycle": options.responses,
+        "seconds": total,
+        "cycles_per_sec": len(cycle_seconds) / total,
+        "first_cycle_seconds": cycle_seconds[0],
+        "statuses": FakeTwitterAPI.statuses,
+        "statuses_with_media": FakeTwitterAPI.media,
+        "items": items,
+        "db_round_trips": round_trips,
+        "requests": server.requests,
+        "bytes": server.bytes,
+        "stages": dict([(stage, stopwatch.summary(stage)) for stage in
+                        ["crawl_cycle", "outbox"] + [stage for (stage, names) in STAGES]])}
+
+    print "*** communities: %d cycles: %d responses/cycle: %d" % (
+        len(communities), len(cycle_seconds), options.responses)
+    print "%8.3f secs %8.2f cycles/sec (first cycle %.3f secs)" % (
+        total, result["cycles_per_sec"], cycle_seconds[0])
+    print "statuses: %d (with media: %d) items: %s" % (
+        FakeTwitterAPI.statuses, FakeTwitterAPI.media,
+        " ".join(["%s=%d" % item for item in sorted(items.items())]))
+    print "%-16s %8s %10s %10s %10s %10s" % ("fetched", "requests", "bytes", "", "", "")
+    for name in sorted(server.requests):
+        print "%-16s %8d %10d" % (name, server.requests[name], server.bytes[name])
+    print "%-16s %8s %10s %10s %10s %10s" % ("stage", "count", "mean ms", "p50 ms", "p95 ms",
+                                             "max ms")
+    for (stage, summary) in sorted(result["stages"].items()):
+        if summary:
+            print "%-16s %8d %10.2f %10.2f %10.2f %10.2f" % (
+                stage, summary["count"], summary["mean"] * 1000, summary["p50"] * 1000,
+                summary["p95"] * 1000, summary["max"] * 1000)
+
+    print "db round trips: %s" % " ".join(
+        ["%s=%d" % item for item in sorted(round_trips.items())])
+
+    if options.json:
+        f = open(options.json, "w")
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline end-to-end benchmark of nicobbs")
+    parser.add_argument("--communities", type=int, default=8)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--responses", type=int, default=30,
+                        help="new responses per bbs page and cycle")
+    parser.add_argument("--crawl-workers", type=int, default=nicobbs.CRAWL_WORKERS)
+    parser.add_argument("--fetch-workers", type=int, default=nicobbs.FETCH_WORKERS)
+    parser.add_argument("--tweet-latency", type=float, default=0,
+                        help="secs the fake twitter api takes for a status")
+    parser.add_argument("--sqlite", action="store_true",
+                        help="use the sqlite storage instead of mongo")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--async-log", action="store_true",
+                        help="write the log in a thread with nicoutil.AsyncHandler")
+    parser.add_argument("--json-log", action="store_true",
+                        help="write the log with nicoutil.JSONFormatter")
+    parser.add_argument("--json", help="writes the results to the file, for comparisons")
+    parser.add_argument("--keep", action="store_true", help="keeps the temporary directory")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
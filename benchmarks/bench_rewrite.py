@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# microbenchmark of nicoutil.replace_body and nicoutil.create_twitter_statuses.
+# compares the precompiled single-pass rewrite with the former pattern-per-call rewrite.
+#
+#   python benchmarks/bench_rewrite.py [bodies] [pieces_per_body]
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import nicoutil  # noqa
+
+PIECES = [
+    u'あるところに、牛を持っている百姓がありました。',
+    u'\n',
+    u'>>sm12345678\nsm12345678',
+    u'>>lv123456789\nlv123456789',
+    u'>>im1234567\nim1234567',
+    u'>>co1234567\nco1234567',
+    u'>>mylist/12345678\nmylist/12345678',
+    u'http://www.chikuwachan.com/live/catalog/index.cgi?category=&sort=room2',
+    u'goo.gl/JGdbXl',
+    u' test@example.com ',
+    u'@account_name',
+    u'＠account',
+    u'。']
+
+
+# former implementation, kept here as the baseline
+def legacy_replace_body(body):
+    for (regexp, base_url) in [(nicoutil.REGEXP_VIDEO, nicoutil.BASE_URL_VIDEO),
+                               (nicoutil.REGEXP_LIVE, nicoutil.BASE_URL_LIVE),
+                               (nicoutil.REGEXP_SEIGA, nicoutil.BASE_URL_SEIGA),
+                               (nicoutil.REGEXP_COMMUNITY, nicoutil.BASE_URL_COMMUNITY),
+                               (nicoutil.REGEXP_MANGA, nicoutil.BASE_URL_MANGA),
+                               (nicoutil.REGEXP_MYLIST, nicoutil.BASE_URL_MYLIST)]:
+        body = re.sub(r'>>(' + regexp + r')\n' + regexp, base_url + r'\1', body)
+    return re.sub(r'\n+$', '', body)
+
+
+def legacy_classify_chunks(body):
+    regexp = u'(%s|%s|%s|%s)' % (nicoutil.REGEXP_HTTP, nicoutil.REGEXP_GOOGLE,
+                                 nicoutil.REGEXP_MAIL, nicoutil.REGEXP_TWITTER)
+    chunk_types = []
+    for chunk in re.split(regexp, body):
+        if not chunk:
+            continue
+        if re.match(nicoutil.REGEXP_HTTP, chunk) or re.match(nicoutil.REGEXP_GOOGLE, chunk):
+            chunk_types.append(nicoutil.CHUNK_TYPE_HTTP)
+        elif re.match(nicoutil.REGEXP_MAIL, chunk):
+            chunk_types.append(nicoutil.CHUNK_TYPE_MAIL)
+        elif re.match(nicoutil.REGEXP_TWITTER, chunk):
+            chunk_types.append(nicoutil.CHUNK_TYPE_TWITTER)
+        else:
+            chunk_types.append(nicoutil.CHUNK_TYPE_TEXT)
+    for chunk in chunks_of(body):
+        re.sub(nicoutil.REGEXP_TWITTER_REPLACE_FROM, nicoutil.REGEXP_TWITTER_REPLACE_TO, chunk)
+    return chunk_types
+
+
+def current_classify_chunks(body):
+    chunk_types = [chunk_type for (chunk_type, chunk) in nicoutil.split_chunks(body)]
+    for chunk in chunks_of(body):
+        nicoutil.COMPILED_TWITTER_REPLACE_FROM.sub(nicoutil.REGEXP_TWITTER_REPLACE_TO, chunk)
+    return chunk_types
+
+
+def chunks_of(body, size=nicoutil.TWITTER_STATUS_MAX_LENGTH):
+    return [body[index:index + size] for index in range(0, len(body), size)]
+
+
+def create_bodies(count, pieces_per_body, pieces=PIECES):
+    random.seed(0)
+    return [u''.join([random.choice(pieces) for unused in range(pieces_per_body)])
+            for unused in range(count)]
+
+
+def bench(name, function, bodies, repeat=3):
+    seconds = min(timeit.repeat(lambda: [function(body) for body in bodies],
+                                number=1, repeat=repeat))
+    characters = sum([len(body) for body in bodies])
+    print "%-28s %8.3f secs %10.0f bodies/sec %10.2f MB/sec" % (
+        name, seconds, len(bodies) / seconds, characters / seconds / 1024 / 1024)
+    return seconds
+
+
+def main():
+    count = int(sys.argv[1]) if 1 < len(sys.argv) else 1000
+    pieces_per_body = int(sys.argv[2]) if 2 < len(sys.argv) else 200
+    for (title, pieces) in [("bodies with links", PIECES), ("plain text bodies", PIECES[:2])]:
+        bodies = create_bodies(count, pieces_per_body, pieces)
+        print "*** %s, bodies: %d characters/body: %d" % (
+            title, count, sum([len(body) for body in bodies]) / count)
+
+        for body in bodies[:10]:
+            assert legacy_replace_body(body) == nicoutil.replace_body(body)
+            assert legacy_classify_chunks(body) == current_classify_chunks(body)
+
+        legacy = bench("replace_body, legacy", legacy_replace_body, bodies)
+        current = bench("replace_body", nicoutil.replace_body, bodies)
+        print "  speedup: %.2fx" % (legacy / current)
+
+        legacy = bench("chunking, legacy", legacy_classify_chunks, bodies)
+        current = bench("chunking", current_classify_chunks, bodies)
+        print "  speedup: %.2fx" % (legacy / current)
+
+        bench("create_twitter_statuses", lambda body: nicoutil.create_twitter_statuses(
+            u"(1234:abcdefg)\n", u'[続き] ', body, u' [続く]'), bodies)
+
+
+if __name__ == "__main__":
+    main()
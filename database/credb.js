@@ -18,18 +18,10 @@ db.video.drop()
 
 */
 
-// drop before create
-db.dropDatabase()
-
-// create index
-db.response.ensureIndex({community:1, number:1})
-db.response.ensureIndex({community:1, status:1})
-db.live.ensureIndex({community:1, link:1})
-db.live.ensureIndex({community:1, status:1})
-db.news.ensureIndex({community:1, date:1})
-db.news.ensureIndex({community:1, status:1})
-db.video.ensureIndex({community:1, link:1})
-db.video.ensureIndex({community:1, status:1})
+// indexes are created and verified by nicobbs at startup, see INDEXES in nicobbs.py.
+// the older indexes below are replaced with the unique and the partial ones by nicobbs.
+//   {community:1, number:1}, {community:1, link:1}, {community:1, date:1}
+//   {community:1, status:1}
 
 /*
 // print content
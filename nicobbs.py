@@ -5,38 +5,139 @@ import os
 import logging
 import logging.config
 import ConfigParser
+import datetime
 import urllib2
-import cookielib
 import re
+import signal
+import sys
+import threading
 import time
 import json
+from multiprocessing.pool import ThreadPool
 
 import nicoutil
-from bs4 import BeautifulSoup
 import pymongo
 import tweepy
 
 NICOBBS_CONFIG = os.path.dirname(os.path.abspath(__file__)) + '/nicobbs.config'
 NICOBBS_CONFIG_SAMPLE = NICOBBS_CONFIG + '.sample'
+NICOBBS_COOKIE = os.path.dirname(os.path.abspath(__file__)) + '/nicobbs.cookie'
+NICOBBS_SQLITE = os.path.dirname(os.path.abspath(__file__)) + '/nicobbs.sqlite'
+# index of the process set by nicobbs.sh when it starts more than one worker. each worker
+# writes its own log and cookie file, like log/nicobbs-1.log
+NICOBBS_WORKER_ENV = 'NICOBBS_WORKER'
 
 LOGIN_URL = 'https://secure.nicovideo.jp/secure/login'
 COMMUNITY_TOP_URL = 'http://com.nicovideo.jp/community/'
 COMMUNITY_VIDEO_URL = 'http://com.nicovideo.jp/video/'
 COMMUNITY_BBS_URL = 'http://com.nicovideo.jp/bbs/'
+BBS_BASE_URL_REGEXP = '(http://dic\.nicovideo\.jp/b/c/[^/]+/)'
 CHANNEL_BASE_URL = 'http://ch.nicovideo.jp/'
 
 DATE_REGEXP = '.*(20../.+/.+\(.+\) .+:.+:.+).*'
+ANCHOR_REGEXP = '>>(\d+)'
+COMPILED_ANCHOR = re.compile(ANCHOR_REGEXP)
 RESID_REGEXP = 'ID: (.+)'
 
-SKIP_LINK_REGEXPS = ["sm\d{5,}", "co\d{5,}", "lv\d{9,}", "ch\d{5,}", "im\d{5,}", "https?://[\w/:%#\$&\?\(\)~\.=\+\-]+"]
+SKIP_ID_REGEXPS = ["sm\d{5,}", "co\d{5,}", "lv\d{9,}", "ch\d{5,}", "im\d{5,}"]
+SKIP_URL_REGEXP = "https?://[\w/:%#\$&\?\(\)~\.=\+\-]+"
+SKIP_LINK_REGEXPS = SKIP_ID_REGEXPS + [SKIP_URL_REGEXP]
 MAX_SKIP_LINKS_IN_RESPONSE = 5
 
 DELETED_MESSAGE = u"削除しました"
 
+# maximum number of older bbs pages read to fill the gap of responses in one crawl
+MAX_GAP_PAGES = 10
+
+# fields of the unprocessed items read to post them, and their order
+ITEM_FIELDS = {"response": ["community", "number", "body", "hash"],
+               "live": ["community", "community_name", "title", "link", "date"],
+               "news": ["community", "title", "name", "desc", "date"],
+               "video": ["community", "title", "link"]}
+ITEM_SORTS = {"response": "number"}
+# fields identifying the items in a community
+ITEM_KEYS = {"response": "number", "live": "link", "news": "date", "video": "link"}
+# default number of the documents in a batch of the cursors for the unprocessed items
+QUERY_BATCH_SIZE = 100
+
+# finished items are moved to the archive after the days, 0 not to archive them
+ARCHIVE_AFTER = 0
+# secs between the archive runs
+ARCHIVE_INTERVAL = 60 * 60
+
+# storage of the items; mongo, or sqlite for a single process without mongod
+STORAGE_MONGO = "mongo"
+STORAGE_SQLITE = "sqlite"
+
+# number of the status ids of the responses kept for the replies, per community
+REPLY_CACHE_SIZE = 10000
+# number of the keys of the stored items kept per collection and community, to skip the
+# items seen in the pages again without queries. the pages list far fewer items.
+SEEN_KEYS_SIZE = 1000
+
+# metrics are exposed as METRICS_NAMESPACE_*, served on the port and/or dumped to the file
+METRICS_NAMESPACE = "nicobbs"
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+METRICS_INTERVAL = 60
+# latency of each stage (read, parse, store, tweet) of each kind, per community
+STAGE_SECONDS = "stage_seconds"
+
+# secs to keep the community name found in the community top page
+COMMUNITY_NAME_TTL = 60 * 60
+
+# video/live titles looked up for the statuses
+METADATA_CACHE_SIZE = 10000
+METADATA_TTL = 24 * 60 * 60
+METADATA_NEGATIVE_TTL = 10 * 60
+
+# maximum secs between the crawl cycles, the pages are polled when they are due
 CRAWL_INTERVAL = 30
-COMMUNITY_INTERVAL = 10
 TWEET_INTERVAL = 3
 
+# pages polled separately; bbs, top page with live and news, and video
+POLL_BBS = "bbs"
+POLL_LIVE_NEWS = "live_news"
+POLL_VIDEO = "video"
+POLL_COLLECTIONS = {POLL_BBS: ["response"],
+                    POLL_LIVE_NEWS: ["live", "news"],
+                    POLL_VIDEO: ["video"]}
+# default bounds of the poll interval of each page, and its backoff factor
+POLL_MIN_INTERVAL = 30
+POLL_MAX_INTERVAL = 30 * 60
+POLL_BACKOFF = 2.0
+# number of the newest items to estimate the initial poll interval
+POLL_WARM_ITEMS = 10
+
+# default token bucket of each twitter account, following the update limits of twitter;
+# 2400 statuses a day, broken into the semi-hourly limits.
+TWEET_BURST = 50
+TWEET_DAILY_LIMIT = 2400
+# secs to stop posting to the account that is over the update limit
+OVER_LIMIT_SUSPEND = 30 * 60
+# maximum secs the outbox waits for new statuses
+OUTBOX_INTERVAL = 30
+
+# shard mode; secs a community lease lasts without heartbeats, and secs between heartbeats
+LEASE_TTL = 60
+LEASE_HEARTBEAT = 15
+
+# default number of communities crawled concurrently
+CRAWL_WORKERS = 4
+# default minimum interval in secs between requests to the same host
+HOST_INTERVAL = 1.0
+# default number of pages fetched concurrently
+FETCH_WORKERS = 8
+# default number of oekaki images downloaded concurrently
+DOWNLOAD_WORKERS = 4
+# secs a status waits for the pending download of its oekaki image
+DOWNLOAD_TIMEOUT = 60
+# oekaki images are saved as IMAGE_DIR/<community>_<response number>.png, the response
+# numbers are unique only in a community
+IMAGE_DIR = "./images/"
+OEKAKI_URL_REGEXP = r'(http:\/\/dic\.nicovideo\.jp\/.*?.png)'
+HASH_KEY_REGEXP = r'(hash_key.*?)"'
+
 # responses/lives just crawled from the web
 STATUS_UNPROCESSED = "UNPROCESSED"
 # spam responses
@@ -52,6 +153,26 @@ STATUS_FAILED = "FAILED"
 # reponses/lives that are successfully posted to twitter
 STATUS_COMPLETED = "COMPLETED"
 
+# indexes created at startup, {collection: [(keys, options), ...]}. the unprocessed items are
+# indexed by the partial indexes, not to index all the finished ones.
+UNPROCESSED_FILTER = {"partialFilterExpression": {"status": STATUS_UNPROCESSED}}
+INDEXES = {
+    "response": [([("community", 1), ("number", 1)], {"unique": True}),
+                 ([("community", 1), ("status", 1), ("number", 1)], UNPROCESSED_FILTER)],
+    "live": [([("community", 1), ("link", 1)], {"unique": True}),
+             ([("community", 1), ("status", 1)], UNPROCESSED_FILTER)],
+    "news": [([("community", 1), ("date", 1)], {"unique": True}),
+             ([("community", 1), ("status", 1)], UNPROCESSED_FILTER)],
+    "video": [([("community", 1), ("link", 1)], {"unique": True}),
+              ([("community", 1), ("status", 1)], UNPROCESSED_FILTER)],
+    "page": [([("url", 1)], {"unique": True})],
+    "community": [([("community", 1)], {"unique": True})],
+    "archived": [([("collection", 1), ("community", 1), ("key", 1)], {})],
+    # mongo removes the cached metadata once it expires
+    "metadata": [([("expires", 1)], {"expireAfterSeconds": 0})]}
+# indexes of database/credb.js replaced by the partial indexes
+OBSOLETE_INDEXES = ["community_1_status_1"]
+
 LOG_SEPARATOR = "---------- ---------- ---------- ---------- ----------"
 
 
@@ -83,19 +204,74 @@ class TwitterOverUpdateLimitError(TwitterStatusUpdateError):
 
 class NicoBBS(object):
     # life cycle
-    def __init__(self):
-        config_file = NICOBBS_CONFIG
-        if not os.path.exists(config_file):
-            config_file = NICOBBS_CONFIG_SAMPLE
-
-        logging.config.fileConfig(config_file)
-        logging.debug("initialized logger w/ file %s" % config_file)
+    def __init__(self, config_file=None):
+        if config_file is None:
+            config_file = NICOBBS_CONFIG
+            if not os.path.exists(config_file):
+                config_file = NICOBBS_CONFIG_SAMPLE
+
+        self.worker = os.environ.get(NICOBBS_WORKER_ENV, "")
+        # the handler args can refer to %(worker_suffix)s
+        logging.config.fileConfig(config_file, {"worker_suffix": self.get_worker_suffix()})
+        logging.debug("initialized logger w/ file %s worker: %s", config_file, self.worker)
+
+        self.metrics = nicoutil.Metrics(METRICS_NAMESPACE)
+        # the records are tagged with the labels of the running stage timers
+        nicoutil.set_log_context(self.metrics.context)
+        self.metrics_port, self.metrics_dump, self.metrics_interval = (
+            self.get_metrics_config(config_file))
+        logging.debug("metrics_port: %d metrics_dump: %s metrics_interval: %d",
+                      self.metrics_port, self.metrics_dump, self.metrics_interval)
 
         self.mail, self.password, database_name, self.ng_words, self.ng_hash = (
             self.get_basic_config(config_file))
         logging.debug(
-            "mail: %s password: xxxxxxxxxx database_name: %s ng_words: %s ng_hash: %s" %
-            (self.mail, database_name, self.ng_words, self.ng_hash))
+            "mail: %s password: xxxxxxxxxx database_name: %s ng_words: %s ng_hash: %s",
+            self.mail, database_name, self.ng_words, self.ng_hash)
+        self.spam_filter = nicoutil.SpamFilter(
+            self.ng_words, self.ng_hash, SKIP_ID_REGEXPS, SKIP_URL_REGEXP,
+            MAX_SKIP_LINKS_IN_RESPONSE)
+
+        (self.crawl_workers, self.host_interval, self.fetch_workers, download_workers,
+         self.cookie_file) = self.get_crawl_config(config_file)
+        self.cookie_file = self.get_worker_path(self.cookie_file)
+        logging.debug("crawl_workers: %d host_interval: %.1f fetch_workers: %d "
+                      "download_workers: %d cookie_file: %s",
+                      self.crawl_workers, self.host_interval, self.fetch_workers,
+                      download_workers, self.cookie_file)
+        self.downloader = nicoutil.Downloader(download_workers)
+        self.throttle = nicoutil.HostThrottle(self.host_interval)
+        self.parser = nicoutil.create_parser(self.get_parser_config(config_file))
+        logging.debug("parser: %s", self.parser.__class__.__name__)
+        self.page_validators = nicoutil.PageValidators()
+        self.bbs_internal_urls = {}
+        self.bbs_hash_keys = {}
+        self.last_response_numbers = {}
+        self.reply_status_ids = {}
+        self.seen_keys = {}
+
+        self.query_batch_size, self.query_all_communities = self.get_query_config(config_file)
+        logging.debug("query_batch_size: %d query_all_communities: %s",
+                      self.query_batch_size, self.query_all_communities)
+        self.unprocessed_items = {}
+        self.community_names = {}
+
+        poll_min_interval, poll_max_interval, poll_backoff = self.get_poll_config(config_file)
+        logging.debug("poll_min_interval: %d poll_max_interval: %d poll_backoff: %.1f",
+                      poll_min_interval, poll_max_interval, poll_backoff)
+        self.poll_schedule = nicoutil.PollSchedule(
+            poll_min_interval, poll_max_interval, poll_backoff)
+
+        self.tweet_interval, self.tweet_burst, self.tweet_daily_limit = (
+            self.get_tweet_config(config_file))
+        logging.debug("tweet_interval: %.1f tweet_burst: %d tweet_daily_limit: %d",
+                      self.tweet_interval, self.tweet_burst, self.tweet_daily_limit)
+        self.tweet_buckets = {}
+        self.tweet_buckets_lock = threading.Lock()
+        self.twitter_apis = {}
+        self.twitter_apis_lock = threading.Lock()
+        self.outbox_event = threading.Event()
+        self.opener = None
 
         self.target_communities = []
         self.consumer_key = {}
@@ -124,23 +300,74 @@ class NicoBBS(object):
             self.response_number_prefix[community] = response_number_prefix
             self.mark_hashes[community] = mark_hashes
 
-            logging.debug("*** community: " + community)
-            logging.debug("consumer_key: %s secret: xxxxx" % self.consumer_key[community])
-            logging.debug("access_key: %s secret: xxxxx" % self.access_key[community])
-            logging.debug("skip_bbs: %d" % self.skip_bbs[community])
-            logging.debug("skip_live: %d" % self.skip_live[community])
-            logging.debug("skip_news: %d" % self.skip_news[community])
-            logging.debug("skip_video: %d" % self.skip_video[community])
-            logging.debug("response_number_prefix: " + self.response_number_prefix[community])
-            logging.debug("mark_hashes: %s" % self.mark_hashes[community])
-
-        self.connection = pymongo.Connection()
-        self.database = self.connection[database_name]
+            logging.debug("*** community: %s", community)
+            logging.debug("consumer_key: %s secret: xxxxx", self.consumer_key[community])
+            logging.debug("access_key: %s secret: xxxxx", self.access_key[community])
+            logging.debug("skip_bbs: %d", self.skip_bbs[community])
+            logging.debug("skip_live: %d", self.skip_live[community])
+            logging.debug("skip_news: %d", self.skip_news[community])
+            logging.debug("skip_video: %d", self.skip_video[community])
+            logging.debug("response_number_prefix: %s", self.response_number_prefix[community])
+            logging.debug("mark_hashes: %s", self.mark_hashes[community])
+
+        storage, sqlite_path = self.get_storage_config(config_file)
+        logging.debug("storage: %s sqlite_path: %s", storage, sqlite_path)
+        self.connection = None
+        self.database = None
+        metadata = None
+        if storage == STORAGE_SQLITE:
+            self.storage = nicoutil.SQLiteStorage(sqlite_path, ITEM_KEYS, STATUS_UNPROCESSED,
+                                                  self.metrics)
+        else:
+            self.connection = pymongo.Connection()
+            # round trips are counted with the community and the stage running in the thread
+            self.database = nicoutil.InstrumentedDatabase(self.connection[database_name],
+                                                          self.metrics)
+            self.storage = nicoutil.MongoStorage(self.database, INDEXES, OBSOLETE_INDEXES,
+                                                 ITEM_KEYS)
+            metadata = self.database.metadata
+
+        self.metadata_cache = nicoutil.MetadataCache(
+            METADATA_CACHE_SIZE, METADATA_TTL, METADATA_NEGATIVE_TTL, metadata,
+            self.fetch_workers)
+
+        self.archive_after, self.archive_dir, self.archive_interval = (
+            self.get_archive_config(config_file))
+        logging.debug("archive_after: %d archive_dir: %s archive_interval: %d",
+                      self.archive_after, self.archive_dir, self.archive_interval)
+        self.archiver = None
+        if self.archive_after:
+            if self.database is None:
+                logging.error("archive is supported only with mongo, items are not archived.")
+            else:
+                self.archiver = nicoutil.Archiver(self.database.archived, self.archive_dir)
+
+        # in shard mode, the processes sharing the database split the communities by leases
+        shard, shard_owner, lease_ttl, self.lease_heartbeat = self.get_shard_config(config_file)
+        logging.debug("shard: %s shard_owner: %s lease_ttl: %d lease_heartbeat: %d",
+                      shard, shard_owner, lease_ttl, self.lease_heartbeat)
+        self.lease_manager = None
+        if shard:
+            if self.database is None:
+                logging.error("shard mode is supported only with mongo, crawling all the "
+                              "communities.")
+            else:
+                self.lease_manager = nicoutil.LeaseManager(
+                    self.database.lease, self.database.worker, shard_owner, lease_ttl)
 
     def __del__(self):
-        self.connection.disconnect()
+        self.storage.close()
+        if self.connection is not None:
+            self.connection.disconnect()
 
 # utility
+    def get_worker_suffix(self):
+        return "-" + self.worker if self.worker else ""
+
+    def get_worker_path(self, path):
+        (root, extension) = os.path.splitext(path)
+        return root + self.get_worker_suffix() + extension
+
     def get_basic_config(self, config_file):
         config = ConfigParser.ConfigParser()
         config.read(config_file)
@@ -162,6 +389,142 @@ class NicoBBS(object):
 
         return mail, password, database_name, ng_words, ng_hash
 
+    def get_crawl_config(self, config_file):
+        defaults = {
+            "crawl_workers": str(CRAWL_WORKERS),
+            "host_interval": str(HOST_INTERVAL),
+            "fetch_workers": str(FETCH_WORKERS),
+            "download_workers": str(DOWNLOAD_WORKERS),
+            "cookie_file": NICOBBS_COOKIE}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        crawl_workers = config.getint(section, "crawl_workers")
+        host_interval = config.getfloat(section, "host_interval")
+        fetch_workers = config.getint(section, "fetch_workers")
+        download_workers = config.getint(section, "download_workers")
+        cookie_file = config.get(section, "cookie_file")
+
+        return crawl_workers, host_interval, fetch_workers, download_workers, cookie_file
+
+    def get_poll_config(self, config_file):
+        defaults = {
+            "poll_min_interval": str(POLL_MIN_INTERVAL),
+            "poll_max_interval": str(POLL_MAX_INTERVAL),
+            "poll_backoff": str(POLL_BACKOFF)}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        poll_min_interval = config.getint(section, "poll_min_interval")
+        poll_max_interval = config.getint(section, "poll_max_interval")
+        poll_backoff = config.getfloat(section, "poll_backoff")
+
+        return poll_min_interval, poll_max_interval, poll_backoff
+
+    def get_query_config(self, config_file):
+        defaults = {
+            "query_batch_size": str(QUERY_BATCH_SIZE),
+            "query_all_communities": "false"}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        query_batch_size = config.getint(section, "query_batch_size")
+        query_all_communities = config.getboolean(section, "query_all_communities")
+
+        return query_batch_size, query_all_communities
+
+    def get_tweet_config(self, config_file):
+        defaults = {
+            "tweet_interval": str(TWEET_INTERVAL),
+            "tweet_burst": str(TWEET_BURST),
+            "tweet_daily_limit": str(TWEET_DAILY_LIMIT)}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        tweet_interval = config.getfloat(section, "tweet_interval")
+        tweet_burst = config.getint(section, "tweet_burst")
+        tweet_daily_limit = config.getint(section, "tweet_daily_limit")
+
+        return tweet_interval, tweet_burst, tweet_daily_limit
+
+    def get_archive_config(self, config_file):
+        defaults = {
+            "archive_after": str(ARCHIVE_AFTER),
+            "archive_dir": "",
+            "archive_interval": str(ARCHIVE_INTERVAL)}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        archive_after = config.getint(section, "archive_after")
+        archive_dir = config.get(section, "archive_dir") or None
+        archive_interval = config.getint(section, "archive_interval")
+
+        return archive_after, archive_dir, archive_interval
+
+    def get_storage_config(self, config_file):
+        defaults = {
+            "storage": STORAGE_MONGO,
+            "sqlite_path": NICOBBS_SQLITE}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        storage = config.get(section, "storage")
+        sqlite_path = config.get(section, "sqlite_path")
+
+        return storage, sqlite_path
+
+    def get_metrics_config(self, config_file):
+        defaults = {
+            "metrics_port": str(METRICS_PORT),
+            "metrics_dump": "",
+            "metrics_interval": str(METRICS_INTERVAL)}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        metrics_port = config.getint(section, "metrics_port")
+        metrics_dump = config.get(section, "metrics_dump") or None
+        metrics_interval = config.getint(section, "metrics_interval")
+
+        return metrics_port, metrics_dump, metrics_interval
+
+    def get_shard_config(self, config_file):
+        defaults = {
+            "shard": "false",
+            "shard_owner": "",
+            "lease_ttl": str(LEASE_TTL),
+            "lease_heartbeat": str(LEASE_HEARTBEAT)}
+
+        config = ConfigParser.ConfigParser(defaults)
+        config.read(config_file)
+        section = "nicobbs"
+
+        shard = config.getboolean(section, "shard")
+        shard_owner = config.get(section, "shard_owner") or nicoutil.default_owner()
+        lease_ttl = config.getint(section, "lease_ttl")
+        lease_heartbeat = config.getint(section, "lease_heartbeat")
+
+        return shard, shard_owner, lease_ttl, lease_heartbeat
+
+    def get_parser_config(self, config_file):
+        config = ConfigParser.ConfigParser({"parser": nicoutil.PARSER_SOUP})
+        config.read(config_file)
+
+        return config.get("nicobbs", "parser")
+
     def get_community_config(self, config_file):
         result = []
 
@@ -207,27 +570,43 @@ class NicoBBS(object):
         return result
 
 # twitter
+    def twitter_api(self, community):
+        # one client per account, created on the first status and reused after that
+        with self.twitter_apis_lock:
+            if community not in self.twitter_apis:
+                auth = tweepy.OAuthHandler(self.consumer_key[community],
+                                           self.consumer_secret[community])
+                auth.set_access_token(self.access_key[community], self.access_secret[community])
+                self.twitter_apis[community] = tweepy.API(auth)
+            return self.twitter_apis[community]
+
     def update_twitter_status(self, community, status, in_reply_to_status_id=0, image_number=0):
-        auth = tweepy.OAuthHandler(self.consumer_key[community], self.consumer_secret[community])
-        auth.set_access_token(self.access_key[community], self.access_secret[community])
+        api = self.twitter_api(community)
 
         # for test; simulating post error like case of api limit
         # raise TwitterStatusUpdateError
 
         try:
+            path = None
             if image_number:
-                path = os.path.abspath("./images/" + image_number + ".png").encode('us-ascii', 'ignore')
+                path = self.get_oekaki_path(community, image_number)
+                if not self.downloader.wait(path, DOWNLOAD_TIMEOUT):
+                    logging.warning("oekaki image is not downloaded, posting without it: %s",
+                                    path)
+                    path = None
+            if path:
+                path = os.path.abspath(path).encode('us-ascii', 'ignore')
                 if in_reply_to_status_id == 0:
-                    status_id = tweepy.API(auth).update_with_media(path, status).id
+                    status_id = api.update_with_media(path, status).id
                 else:
-                    status_id = tweepy.API(auth).update_with_media(path, status, in_reply_to_status_id).id
+                    status_id = api.update_with_media(path, status, in_reply_to_status_id).id
             else:
                 if in_reply_to_status_id == 0:
-                    status_id = tweepy.API(auth).update_status(status).id
+                    status_id = api.update_status(status).id
                 else:
-                    status_id = tweepy.API(auth).update_status(status, in_reply_to_status_id).id
+                    status_id = api.update_status(status, in_reply_to_status_id).id
         except tweepy.error.TweepError, error:
-            logging.error("twitter update error: %s" % error)
+            logging.error("twitter update error: %s", error)
             # error.reason is the list object like following:
             #   [{"message":"Sorry, that page does not exist","code":34}]
             # see the following references for details:
@@ -268,16 +647,31 @@ class NicoBBS(object):
             raise TwitterStatusUpdateError()
         return str(status_id)
 
+    def tweet_bucket(self, community):
+        with self.tweet_buckets_lock:
+            if community not in self.tweet_buckets:
+                self.tweet_buckets[community] = nicoutil.TokenBucket(
+                    self.tweet_burst, self.tweet_daily_limit / (24.0 * 60 * 60),
+                    self.tweet_interval)
+            return self.tweet_buckets[community]
+
+    def can_tweet(self, community):
+        # waiting for the interval between statuses is fine, but not for the empty bucket
+        delay = self.tweet_bucket(community).delay()
+        if self.tweet_interval < delay:
+            logging.info("no tweet tokens left, community: %s delay: %.1f secs",
+                         community, delay)
+            return False
+        return True
+
     def tweet_statuses(self, community, statuses, update_handler, update_target, tweet_count=0, status_id=0):
         for status in statuses:
-            if 0 < tweet_count:
-                logging.debug("sleeping %d secs before next tweet..." % TWEET_INTERVAL)
-                time.sleep(TWEET_INTERVAL)
+            self.tweet_bucket(community).acquire()
 
             try:
-                murl = re.search("(http:\/\/dic\.nicovideo\.jp\/.*?.png)", status)
+                murl = re.search(OEKAKI_URL_REGEXP, status)
                 if murl:
-                    status = re.sub("(http:\/\/dic\.nicovideo\.jp\/.*?.png)", "", status)
+                    status = re.sub(OEKAKI_URL_REGEXP, "", status)
                     number = re.search("(\d+)", status).group(1)
                     status_id = self.update_twitter_status(community, status, status_id, number)
                 else:
@@ -285,31 +679,32 @@ class NicoBBS(object):
             except TwitterDuplicateStatusUpdateError, error:
                 # status is already posted to twitter. so response status should be
                 # changed from 'unprocessed' to other, in order to avoid reprocessing
-                logging.error("twitter status update error, duplicate: %s" % error)
+                logging.error("twitter status update error, duplicate: %s", error)
                 update_handler(update_target, STATUS_DUPLICATE)
                 break
             except TwitterOverUpdateLimitError, error:
                 # quit this status update sequence
-                logging.error("twitter status update error, over limit: %s" % error)
+                logging.error("twitter status update error, over limit: %s", error)
                 raise
             except TwitterOverCharactersStatusUpdateError, error:
                 # status has over 140 characters. this is possible nicobbs bug.
-                logging.error("twitter status update error, over characters: %s" % error)
+                logging.error("twitter status update error, over characters: %s", error)
                 update_handler(update_target, STATUS_OVER_CHARS)
                 break
             except TwitterSpamStatusUpdateError, error:
                 # spam rejected from twitter
-                logging.error("twitter status update error, spam: %s" % error)
+                logging.error("twitter status update error, spam: %s", error)
                 update_handler(update_target, STATUS_SPAM)
                 break
             except TwitterStatusUpdateError, error:
                 # twitter error case including api limit
                 # response status should not be changed here for future retrying
-                logging.error("twitter status update error, unknown: %s" % error)
+                logging.error("twitter status update error, unknown: %s", error)
                 break
             else:
                 update_handler(update_target, STATUS_COMPLETED, status_id)
-                logging.info("status updated: [%s]" % status)
+                logging.info("status updated: [%s]", status)
+                self.metrics.increment("statuses_total", community=community)
 
             tweet_count += 1
 
@@ -317,17 +712,28 @@ class NicoBBS(object):
 
 # network utility
     def create_opener(self):
-        # cookie
-        cookiejar = cookielib.CookieJar()
-        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookiejar))
-        # logging.debug("finished setting up cookie library")
-
-        # login
-        opener.open(LOGIN_URL, "mail=%s&password=%s" % (self.mail, self.password))
-        logging.info("finished login")
+        # long-lived session; cookies are persisted to the cookie file, and login is
+        # performed again only when a response shows that the session has expired.
+        opener = nicoutil.NicoSession(LOGIN_URL, self.mail, self.password, self.cookie_file,
+                                      self.throttle, self.fetch_workers, self.page_validators,
+                                      self.metrics)
+        if not opener.has_cookies():
+            opener.login()
 
         return opener
 
+    def is_page_unchanged(self, url, reader, rawhtml):
+        unchanged = self.page_validators.is_unchanged(url, reader, rawhtml)
+        if unchanged:
+            logging.info("page is not modified, skip parsing: %s", url)
+        return unchanged
+
+    def commit_page(self, url):
+        # validators are committed after the page is stored, so a failed cycle reads it again
+        page = self.page_validators.commit(url)
+        if page:
+            self.register_page(url, page)
+
 # message utility
     def prefilter_message(self, message):
         message = re.sub("<br/>", "\n", message)
@@ -351,119 +757,248 @@ class NicoBBS(object):
 
 # misc utility
     def find_community_name(self, rawhtml, community):
-        soup = BeautifulSoup(rawhtml)
+        cached = self.community_names.get(community)
+        if cached and time.time() < cached[1]:
+            return cached[0]
 
-        if self.is_channel(community):
-            return soup.find("h1", {"class": "channel_name"}).text
-        else:
-            return soup.find("h1", {"id": "community_name"}).text
+        community_name = self.parser.extract_community_name(rawhtml, self.is_channel(community))
+        self.community_names[community] = (community_name, time.time() + COMMUNITY_NAME_TTL)
+        return community_name
+
+    def active_communities(self):
+        if self.lease_manager is None:
+            return self.target_communities
+        return self.lease_manager.held(self.target_communities)
 
     def is_channel(self, community_id):
         return re.match(r'^co\d+$', community_id) is None
 
-# mongo
+# storage
+    # index
+    def bootstrap_indexes(self):
+        self.storage.bootstrap()
+
+    # page
+    def register_page(self, url, page):
+        self.storage.save_page(url, page)
+
+    def load_pages(self):
+        for page in self.storage.load_pages():
+            self.page_validators.load(
+                page["url"], page.get("etag"), page.get("last_modified"), page.get("digest"))
+
+    # community
+    def get_last_response_number(self, community):
+        if community not in self.last_response_numbers:
+            state = self.storage.find_community(community)
+            number = 0
+            if state and "last_response_number" in state:
+                number = state["last_response_number"]
+            self.last_response_numbers[community] = number
+        return self.last_response_numbers[community]
+
+    def update_last_response_number(self, community, number):
+        if number <= self.get_last_response_number(community):
+            return
+        self.last_response_numbers[community] = number
+        self.storage.update_community(community, {"last_response_number": number})
+
+    # seen keys
+    def get_seen_keys(self, collection, community):
+        # keys known to be stored, items are never removed but archived, so they are kept
+        # until they are evicted.
+        if (collection, community) not in self.seen_keys:
+            self.seen_keys[(collection, community)] = nicoutil.LRUCache(SEEN_KEYS_SIZE)
+        return self.seen_keys[(collection, community)]
+
+    def warm_seen_keys(self):
+        for community in self.target_communities:
+            for (collection, key) in sorted(ITEM_KEYS.items()):
+                seen_keys = self.get_seen_keys(collection, community)
+                for item_key in reversed(self.storage.find_recent_keys(
+                        collection, community, key, SEEN_KEYS_SIZE)):
+                    seen_keys.put(item_key, True)
+
+    def count_seen_keys(self, collection, hits, misses):
+        self.metrics.increment("seen_keys_total", hits, collection=collection, result="hit")
+        self.metrics.increment("seen_keys_total", misses, collection=collection, result="miss")
+
+    # batch
+    def register_items(self, collection, community, items):
+        # one query for the keys not seen yet and one insert for the new items, instead of
+        # a count and an upsert for each item. returns (registered items, skipped items)
+        key = ITEM_KEYS[collection]
+        keys = [item[key] for item in items]
+        seen_keys = self.get_seen_keys(collection, community)
+        existing_keys = set([item_key for item_key in keys if item_key in seen_keys])
+        unseen_keys = [item_key for item_key in keys if item_key not in existing_keys]
+        self.count_seen_keys(collection, len(keys) - len(unseen_keys), len(unseen_keys))
+        existing_keys.update(self.storage.find_keys(collection, community, key, unseen_keys))
+
+        # the archived items are still listed in the pages, like the news
+        missing_keys = [item_key for item_key in unseen_keys if item_key not in existing_keys]
+        if missing_keys:
+            existing_keys.update([document["key"] for document in self.find_archived(
+                collection, community, missing_keys)])
+
+        registered_items = []
+        skipped_items = []
+        for item in items:
+            if item[key] in existing_keys:
+                skipped_items.append(item)
+            else:
+                registered_items.append(item)
+                existing_keys.add(item[key])
+
+        if registered_items:
+            self.storage.insert_items(collection, registered_items)
+        for item_key in existing_keys:
+            seen_keys.put(item_key, True)
+
+        return registered_items, skipped_items
+
+    def register_item(self, collection, item):
+        self.storage.upsert_item(collection, ITEM_KEYS[collection], item)
+
+    def is_item_registered(self, collection, item):
+        key = ITEM_KEYS[collection]
+        seen_keys = self.get_seen_keys(collection, item["community"])
+        if item[key] in seen_keys:
+            return True
+        if self.storage.find_keys(collection, item["community"], key, [item[key]]):
+            seen_keys.put(item[key], True)
+            return True
+        return False
+
+    def update_item_status(self, collection, item, status, status_id):
+        key = ITEM_KEYS[collection]
+        self.storage.update_status(
+            collection, item["community"], key, item[key], status, status_id)
+
+    def find_archived(self, collection, community, keys):
+        return self.storage.find_archived(collection, community, keys)
+
+    def find_items_with_status(self, collection, communities, status):
+        return self.storage.find_items(collection, communities, status, ITEM_FIELDS[collection],
+                                       ITEM_SORTS.get(collection), self.query_batch_size)
+
+    def prefetch_unprocessed_items(self, communities):
+        # one query per collection for all the communities, handed out by
+        # get_unprocessed_items() until the next prefetch
+        unprocessed_items = {}
+        for collection in ITEM_FIELDS:
+            items = {}
+            for item in self.find_items_with_status(collection, communities, STATUS_UNPROCESSED):
+                items.setdefault(item["community"], []).append(item)
+            unprocessed_items[collection] = items
+        self.unprocessed_items = unprocessed_items
+
+    def get_unprocessed_items(self, collection, community):
+        prefetched = self.unprocessed_items.get(collection)
+        if prefetched is not None:
+            return prefetched.pop(community, [])
+        return self.find_items_with_status(collection, [community], STATUS_UNPROCESSED)
+
     # response
     def register_response(self, response):
-        self.database.response.update(
-            {"community": response["community"], "number": response["number"]}, response, True)
+        self.register_item("response", response)
 
     def is_response_registered(self, response):
-        count = self.database.response.find(
-            {"community": response["community"], "number": response["number"]}).count()
-        return True if 0 < count else False
+        return self.is_item_registered("response", response)
 
-    def get_responses_with_community_and_status(self, community, status):
-        responses = self.database.response.find(
-            {"community": community, "status": status},
-            sort=[("number", 1)])
-        return responses
+    def register_responses(self, responses, community):
+        return self.register_items("response", community, responses)
 
-    def get_response_with_community_and_number(self, community, number):
-        responses = self.database.response.find(
-            {"community": community, "number": number})
-        return responses
+    def get_responses_with_community_and_status(self, community, status):
+        return self.find_items_with_status("response", [community], status)
 
     def update_response_status(self, response, status, status_id=0):
-        self.database.response.update(
-            {"community": response["community"], "number": response["number"]},
-            {"$set": {"status": status, "status_id": status_id}})
+        self.update_item_status("response", response, status, status_id)
+        self.get_reply_status_ids(response["community"]).put(response["number"], status_id)
+
+    # reply
+    def get_reply_status_ids(self, community):
+        if community not in self.reply_status_ids:
+            self.reply_status_ids[community] = nicoutil.LRUCache(REPLY_CACHE_SIZE)
+        return self.reply_status_ids[community]
+
+    def load_reply_status_ids(self, community, numbers):
+        # status ids of the anchored responses are read in one query, and kept with the
+        # ones updated by update_response_status(). missing responses are kept as 0 too.
+        status_ids = self.get_reply_status_ids(community)
+        misses = sorted(set([number for number in numbers if number not in status_ids]))
+        if not misses:
+            return
+
+        found = self.storage.find_status_ids("response", community, "number", misses)
+        archived = [number for number in misses if number not in found]
+        if archived:
+            for response in self.find_archived("response", community, archived):
+                found[response["key"]] = response.get("status_id", 0)
+        for number in misses:
+            status_ids.put(number, found.get(number, 0))
+
+    def get_reply_status_id(self, community, number):
+        self.load_reply_status_ids(community, [number])
+        return self.get_reply_status_ids(community).get(number, 0)
 
     # reserved live
     def register_live(self, live):
-        self.database.live.update(
-            {"community": live["community"], "link": live["link"]}, live, True)
+        self.register_item("live", live)
 
     def is_live_registered(self, live):
-        count = self.database.live.find(
-            {"community": live["community"], "link": live["link"]}).count()
-        return True if 0 < count else False
+        return self.is_item_registered("live", live)
+
+    def register_lives(self, lives, community):
+        return self.register_items("live", community, lives)
 
     def get_lives_with_community_and_status(self, community, status):
-        lives = self.database.live.find({"community": community, "status": status})
-        return lives
+        return self.find_items_with_status("live", [community], status)
 
     def update_live_status(self, live, status, status_id=0):
-        self.database.live.update(
-            {"community": live["community"], "link": live["link"]},
-            {"$set": {"status": status, "status_id": status_id}})
+        self.update_item_status("live", live, status, status_id)
 
     # news
     def register_news(self, news):
-        self.database.news.update(
-            {"community": news["community"], "date": news["date"]}, news, True)
+        self.register_item("news", news)
 
     def is_news_registered(self, news):
-        count = self.database.news.find(
-            {"community": news["community"], "date": news["date"]}).count()
-        return True if 0 < count else False
+        return self.is_item_registered("news", news)
+
+    def register_news_items(self, news_items, community):
+        return self.register_items("news", community, news_items)
 
     def get_news_with_community_and_status(self, community, status):
-        news = self.database.news.find({"community": community, "status": status})
-        return news
+        return self.find_items_with_status("news", [community], status)
 
     def update_news_status(self, news, status, status_id=0):
-        self.database.news.update(
-            {"community": news["community"], "date": news["date"]},
-            {"$set": {"status": status, "status_id": status_id}})
+        self.update_item_status("news", news, status, status_id)
 
     # video
     def register_video(self, video):
-        self.database.video.update(
-            {"community": video["community"], "link": video["link"]}, video, True)
+        self.register_item("video", video)
 
     def is_video_registered(self, video):
-        count = self.database.video.find(
-            {"community": video["community"], "link": video["link"]}).count()
-        return True if 0 < count else False
+        return self.is_item_registered("video", video)
+
+    def register_videos(self, videos, community):
+        return self.register_items("video", community, videos)
 
     def get_video_with_community_and_status(self, community, status):
-        videos = self.database.video.find({"community": community, "status": status})
-        return videos
+        return self.find_items_with_status("video", [community], status)
 
     def update_video_status(self, video, status, status_id=0):
-        self.database.video.update(
-            {"community": video["community"], "link": video["link"]},
-            {"$set": {"status": status, "status_id": status_id}})
+        self.update_item_status("video", video, status, status_id)
 
 # filter
     def contains_ng_words(self, message):
-        for word in self.ng_words:
-            if re.search(word, message):
-                return True
-        return False
+        return self.spam_filter.contains_ng_words(message)
 
     def contains_too_many_link(self, message):
-        for regexp in SKIP_LINK_REGEXPS:
-            matches = re.findall(regexp, message)
-            if MAX_SKIP_LINKS_IN_RESPONSE < len(matches):
-                return True
-        return False
+        return self.spam_filter.contains_too_many_link(message)
 
     def contains_ng_hash(self, hash_id):
-        for word in self.ng_hash:
-            if word == hash_id:
-                return True
-        return False
+        return self.spam_filter.contains_ng_hash(hash_id)
 
     def is_deleted_message(self, message):
         return message == DELETED_MESSAGE
@@ -474,24 +1009,34 @@ class NicoBBS(object):
     #     return str(intnum - ((intnum-1) % 30))
 
 # main, bbs
+    def get_oekaki_path(self, community, number):
+        return IMAGE_DIR + community + "_" + number + ".png"
+
     def save_bbs_oekaki(self, opener, community, responses):
+        # images are downloaded in the background, and the statuses wait for them in
+        # update_twitter_status(). the images already on the disk are skipped.
+        hash_key = self.bbs_hash_keys.get(community)
+        submitted = 0
         for response in responses:
-            response_body = response["body"]
-            murl = re.search(".*?(http:\/\/dic\.nicovideo\.jp\/.*?.png).*?", response_body)
+            murl = re.search(OEKAKI_URL_REGEXP, response["body"])
             if murl:
-                image_url = murl.group(1)
-                url = COMMUNITY_BBS_URL + community
-                hash_key = re.search("(hash_key.*?)\"", opener.open(url).read()).group(1)
-                reader = opener.open(image_url + "?" + hash_key)
-                local = open("./images/" + response["number"] + ".png", 'wb')
-                local.write(reader.read())
-                local.close()
+                if hash_key is None:
+                    logging.warning("no hash_key for oekaki images, community: %s", community)
+                    break
+                if self.downloader.submit(opener, murl.group(1) + "?" + hash_key,
+                                          self.get_oekaki_path(community, response["number"])):
+                    submitted += 1
+        if submitted:
+            logging.info("downloading %d oekaki images, community: %s", submitted, community)
+
+    def get_response_page_url(self, community):
+        if self.is_channel(community):
+            return CHANNEL_BASE_URL + community + '/bbs'
+        return COMMUNITY_BBS_URL + community
 
     def read_response_page(self, opener, community):
-        url = COMMUNITY_BBS_URL + community
-        if self.is_channel(community):
-            url = CHANNEL_BASE_URL + community + '/bbs'
-        logging.info("*** reading community bbs page, target: " + url)
+        url = self.get_response_page_url(community)
+        logging.info("*** reading community bbs page, target: %s", url)
         # logging.debug(url)
 
         reader = opener.open(url)
@@ -502,39 +1047,83 @@ class NicoBBS(object):
         # use scraping by regular expression, instead of by beautifulsoup.
         se = re.search('<iframe src="(http://dic\.nicovideo\.jp/.+?)"', rawhtml)
         internal_url = se.group(1)
-        logging.debug("bbs internal url: " + internal_url)
+        # the key to download the oekaki images, read once per front page
+        matched = re.search(HASH_KEY_REGEXP, rawhtml)
+        if matched:
+            self.bbs_hash_keys[community] = matched.group(1)
+        logging.debug("bbs internal url: %s", internal_url)
+        self.bbs_internal_urls[community] = internal_url
 
         reader = opener.open(internal_url)
         rawhtml = reader.read()
         logging.info("finished to read bbs page.")
         # logging.debug(rawhtml)
 
+        if self.is_page_unchanged(internal_url, reader, rawhtml):
+            return None
+
         return rawhtml
 
+    def read_response_gap_page(self, opener, community, number):
+        matched = re.match(BBS_BASE_URL_REGEXP, self.bbs_internal_urls.get(community, ""))
+        if not matched:
+            return None
+        url = matched.group(1) + "%d-" % number
+        logging.info("*** reading older bbs page, target: %s", url)
+
+        reader = opener.open(url)
+        rawhtml = reader.read()
+        logging.info("finished to read older bbs page.")
+
+        return rawhtml
+
+    def fill_response_gap(self, opener, community, responses):
+        last_number = self.get_last_response_number(community)
+        if not (last_number and responses):
+            return responses
+
+        first_number = int(responses[0]["number"])
+        next_number = last_number + 1
+        gap_responses = []
+        pages = 0
+
+        # the latest page does not reach the last crawled response, so read the older pages
+        while next_number < first_number and pages < MAX_GAP_PAGES:
+            logging.info("detected response gap #%d-#%d, community: %s",
+                         next_number, first_number - 1, community)
+            with self.stage_timer(community, "bbs", "read"):
+                rawhtml = self.read_response_gap_page(opener, community, next_number)
+            if rawhtml is None:
+                break
+            with self.stage_timer(community, "bbs", "parse"):
+                found = [response for response in self.parse_response(rawhtml, community)
+                         if int(response["number"]) < first_number]
+            if not found:
+                break
+            gap_responses.extend(found)
+            next_number = int(found[-1]["number"]) + 1
+            pages += 1
+
+        return gap_responses + responses
+
     def parse_response(self, rawhtml, community):
-        logging.info("*** parsing responses, community: %s" % community)
+        logging.info("*** parsing responses, community: %s", community)
 
-        soup = BeautifulSoup(rawhtml)
-        resheads = soup.findAll("dt", {"class": "reshead"})
-        resbodies = soup.findAll("dd", {"class": "resbody"})
+        last_number = self.get_last_response_number(community)
         responses = []
-        index = 0
 
-        for reshead in resheads:
-            # extract
-            number = reshead.find("a", {"class": "resnumhead"})["name"]
-            name = reshead.find("span", {"class": "name"}).text.strip()
+        # response numbers only increase, so already crawled ones are dropped by the parser
+        for (number, name, head_text, body) in self.parser.extract_responses(rawhtml,
+                                                                             last_number):
             # use "search", instead of "mathch". http://www.python.jp/doc/2.6/library/re.html#vs
             date = "n/a"
-            se = re.search(DATE_REGEXP, reshead.text.strip())
+            se = re.search(DATE_REGEXP, head_text)
             if se:
                 date = se.group(1)
-            hash_id = re.search(RESID_REGEXP, reshead.text.strip()).group(1)
-            body = "".join([unicode(x) for x in resbodies[index]]).strip()
+            hash_id = re.search(RESID_REGEXP, head_text).group(1)
             body = self.prefilter_message(body)
             # logging.debug(u"[%s] [%s] [%s] [\n%s\n]".encode('utf_8') %
             # (number, name, date, body))
-            index += 1
 
             # if not self.is_valid_response(community, number):
             #     continue
@@ -551,7 +1140,7 @@ class NicoBBS(object):
             }
             responses.append(response)
 
-        logging.info("scraped %s responses." % len(responses))
+        logging.info("scraped %s responses.", len(responses))
 
         return responses
 
@@ -570,57 +1159,61 @@ class NicoBBS(object):
             # logging.debug("response is valid.")
             pass
         else:
-            logging.warning("response is NOT valid, should skip. %s,%s" % (community, number))
+            logging.warning("response is NOT valid, should skip. %s,%s", community, number)
 
         return has_valid_response_number
 
     def store_response(self, responses, community):
-        logging.info("*** storing responses, community: %s" % community)
+        logging.info("*** storing responses, community: %s", community)
 
-        skipped_responses = []
-        registered_responses = []
+        registered, skipped = self.register_responses(responses, community)
 
-        for response in responses:
-            response_number = "#%s" % response["number"]
-            if self.is_response_registered(response):
-                skipped_responses.append(response_number)
-            else:
-                self.register_response(response)
-                registered_responses.append(response_number)
+        if responses:
+            self.update_last_response_number(
+                community, max([int(response["number"]) for response in responses]))
 
-        logging.debug("skipped: %s" % skipped_responses)
-        logging.debug("registered: %s" % registered_responses)
+        if nicoutil.is_debug_enabled():
+            logging.debug("skipped: %s", ["#%s" % response["number"] for response in skipped])
+            logging.debug("registered: %s",
+                          ["#%s" % response["number"] for response in registered])
         logging.info("finished to store responses.")
 
+        return len(registered)
+
     def tweet_response(self, opener, community, response_number_prefix="", mark_hashes=[], limit=0):
-        unprocessed_responses = self.get_responses_with_community_and_status(
-            community, STATUS_UNPROCESSED)
+        unprocessed_responses = list(self.get_unprocessed_items("response", community))
         tweet_count = 0
 
-        logging.info("*** processing responses, community: %s unprocessed: %d" %
-                     (community, unprocessed_responses.count()))
+        logging.info("*** processing responses, community: %s unprocessed: %d",
+                     community, len(unprocessed_responses))
+
+        # anchors in the statuses come from the bodies, resolve all of them at once
+        self.load_reply_status_ids(community, [
+            number for response in unprocessed_responses
+            for number in COMPILED_ANCHOR.findall(response["body"])])
 
         for response in unprocessed_responses:
-            logging.debug("processing response #%s" % response["number"])
+            logging.debug("processing response #%s", response["number"])
 
             response_number = response_number_prefix + response["number"]
             # response_name = response["name"]
             response_body = response["body"]
             response_hash = response["hash"]
 
-            if (self.contains_ng_words(response_body) or
-                    self.contains_ng_hash(response_hash) or
-                    self.contains_too_many_link(response_body)):
+            if self.spam_filter.is_spam(response_body, response_hash):
                 logging.debug(
-                    "response contains ng word | hash/too many video, so skip: [%s]" % response_body)
+                    "response contains ng word | hash/too many video, so skip: [%s]", response_body)
                 self.update_response_status(response, STATUS_SPAM)
                 continue
 
             if self.is_deleted_message(response_body):
-                logging.debug("response is deleted, so skip: [%s]" % response_body)
+                logging.debug("response is deleted, so skip: [%s]", response_body)
                 self.update_response_status(response, STATUS_DELETED)
                 continue
 
+            if not self.can_tweet(community):
+                break
+
             # create statuses
             response_body = self.postfilter_message(response_body)
 
@@ -630,116 +1223,94 @@ class NicoBBS(object):
             header += u'\n'
 
             statuses = nicoutil.create_twitter_statuses(
-                header, u'[続き] ', response_body, u' [続く]', opener)
+                header, u'[続き] ', response_body, u' [続く]', opener, self.metadata_cache)
 
-            anchor = re.search(">>(\d+)", statuses[0])
+            status_id = 0
+            anchor = COMPILED_ANCHOR.search(statuses[0])
             if anchor:
-                num_response = self.get_response_with_community_and_number(community, anchor.group(1))
-                if num_response.count() == 0:
-                    tweet_count = self.tweet_statuses(
-                        community, statuses, self.update_response_status, response, tweet_count)
-                else:
-                    r = num_response.next()
-                    if 'status_id' in r:
-                        tweet_count = self.tweet_statuses(
-                            community, statuses, self.update_response_status, response, tweet_count, r['status_id'])
-                    else:
-                        tweet_count = self.tweet_statuses(
-                            community, statuses, self.update_response_status, response, tweet_count)
+                status_id = self.get_reply_status_id(community, anchor.group(1))
 
-            else:
-                tweet_count = self.tweet_statuses(
-                    community, statuses, self.update_response_status, response, tweet_count)
+            tweet_count = self.tweet_statuses(
+                community, statuses, self.update_response_status, response, tweet_count, status_id)
 
             if limit and limit <= tweet_count:
-                logging.info("breaking tweet processing, limit: %d tweet_count: %d" %
-                             (limit, tweet_count))
+                logging.info("breaking tweet processing, limit: %d tweet_count: %d",
+                             limit, tweet_count)
                 break
 
         logging.info("finished to process responses.")
 
+        return tweet_count
+
 # main, reserved live
-    def read_reserved_live_page(self, opener, community):
-        url = COMMUNITY_TOP_URL + community
+    def get_reserved_live_page_url(self, community):
         if self.is_channel(community):
-            url = CHANNEL_BASE_URL + community + '/live'
-        logging.info("*** reading reserved live page, target: " + url)
+            return CHANNEL_BASE_URL + community + '/live'
+        return COMMUNITY_TOP_URL + community
+
+    def read_reserved_live_page(self, opener, community):
+        url = self.get_reserved_live_page_url(community)
+        logging.info("*** reading reserved live page, target: %s", url)
 
         reader = opener.open(url)
         rawhtml = reader.read()
         # logging.debug(rawhtml)
         logging.info("finished to read reserved live page.")
 
+        if self.is_page_unchanged(url, reader, rawhtml):
+            return None
+
         return rawhtml
 
     def parse_reserved_live(self, rawhtml, community):
-        logging.info("*** parsing reserved lives, community: %s" % community)
+        logging.info("*** parsing reserved lives, community: %s", community)
 
         community_name = self.find_community_name(rawhtml, community)
 
         reserved_lives = []
-        soup = BeautifulSoup(rawhtml)
 
-        if self.is_channel(community):
-            section = soup.find("section", {"class": "future"})
-            if section:
-                lives = section.find_all("div", {"class": "item_right"})
-                for live in lives:
-                    title = live.find("h6", {"class": "title"})
-                    link = title.find("a")["href"]
-                    date = live.find("p", {"class": "date"}).text
-                    reserved_live = {"community": community,
-                                     "community_name": community_name,
-                                     "title": title.text,
-                                     "link": link,
-                                     "date": date,
-                                     "status": STATUS_UNPROCESSED}
-                    reserved_lives.append(reserved_live)
-        else:
-            lives = soup.findAll("div", {"class": "item"})
-
-            for live in lives:
-                date = live.find("p", {"class": "date"})
-                title = live.find("p", {"class": "title"})
-                if title:
-                    anchor = title.find("a")
-                    link = anchor["href"]
-                    se = re.search("/gate/", link)
-                    if se:
-                        reserved_live = {"community": community,
-                                         "community_name": community_name,
-                                         "title": anchor.text,
-                                         "link": link,
-                                         "date": date.text,
-                                         "status": STATUS_UNPROCESSED}
-                        reserved_lives.append(reserved_live)
-
-        logging.info("scraped %s reserved lives." % len(reserved_lives))
+        for (title, link, date) in self.parser.extract_reserved_lives(
+                rawhtml, self.is_channel(community)):
+            # user community lists the past lives too, only the reserved ones have the gate link
+            if not self.is_channel(community) and not re.search("/gate/", link):
+                continue
+            reserved_live = {"community": community,
+                             "community_name": community_name,
+                             "title": title,
+                             "link": link,
+                             "date": date,
+                             "status": STATUS_UNPROCESSED}
+            reserved_lives.append(reserved_live)
+
+        logging.info("scraped %s reserved lives.", len(reserved_lives))
 
         return reserved_lives
 
     def store_reserved_live(self, reserved_lives, community):
-        logging.info("*** storing reserved lives, community: %s" % community)
+        logging.info("*** storing reserved lives, community: %s", community)
 
-        for reserved_live in reserved_lives:
-            if self.is_live_registered(reserved_live):
-                logging.debug("skipped: %s" % reserved_live["link"])
-            else:
-                self.register_live(reserved_live)
-                logging.debug("registered: %s" % reserved_live["link"])
+        registered, skipped = self.register_lives(reserved_lives, community)
+        for reserved_live in skipped:
+            logging.debug("skipped: %s", reserved_live["link"])
+        for reserved_live in registered:
+            logging.debug("registered: %s", reserved_live["link"])
 
         logging.info("finished to store reserved lives.")
 
+        return len(registered)
+
     def tweet_reserved_live(self, community, limit=0):
-        unprocessed_lives = self.get_lives_with_community_and_status(
-            community, STATUS_UNPROCESSED)
+        unprocessed_lives = self.get_unprocessed_items("live", community)
         tweet_count = 0
+        processed = 0
 
-        logging.info("*** processing lives, community: %s unprocessed: %d" %
-                     (community, unprocessed_lives.count()))
+        logging.info("*** processing lives, community: %s", community)
 
         for live in unprocessed_lives:
-            logging.debug("processing live %s" % live["link"])
+            processed += 1
+            logging.debug("processing live %s", live["link"])
+            if not self.can_tweet(community):
+                break
 
             status = (u"【放送予約】「" + live["community_name"] + u"」で生放送「" +
                       live["title"] + u"」が予約されました。" + live["date"] + u" " +
@@ -749,20 +1320,22 @@ class NicoBBS(object):
                 community, [status], self.update_live_status, live, tweet_count)
 
             if limit and limit <= tweet_count:
-                logging.info("breaking tweet processing, limit: %d tweet_count: %d" %
-                             (limit, tweet_count))
+                logging.info("breaking tweet processing, limit: %d tweet_count: %d",
+                             limit, tweet_count)
                 break
 
-        logging.info("finished to process reserved lives.")
+        logging.info("finished to process reserved lives, processed: %d", processed)
+
+        return tweet_count
 
 # main, news
     def parse_news(self, rawhtml, community):
-        logging.info("*** parsing community news, community: %s" % community)
+        logging.info("*** parsing community news, community: %s", community)
 
         community_name = self.find_community_name(rawhtml, community)
 
         news_items = []
-        soup = BeautifulSoup(rawhtml)
+        soup = nicoutil.parsed_document(rawhtml).soup
 
         community_news_tag = soup.find(id="community_news")
         if community_news_tag:
@@ -789,32 +1362,35 @@ class NicoBBS(object):
                              "status": STATUS_UNPROCESSED}
                 news_items.append(news_item)
 
-        logging.info("scraped %s news." % len(news_items))
+        logging.info("scraped %s news.", len(news_items))
 
         return news_items
 
     def store_news(self, news_items, community):
-        logging.info("*** crawling news, community: %s" % community)
+        logging.info("*** crawling news, community: %s", community)
 
-        for news_item in news_items:
-            if self.is_news_registered(news_item):
-                logging.debug("skipped: %s" % news_item["date"])
-            else:
-                self.register_news(news_item)
-                logging.debug("registered: %s" % news_item["date"])
+        registered, skipped = self.register_news_items(news_items, community)
+        for news_item in skipped:
+            logging.debug("skipped: %s", news_item["date"])
+        for news_item in registered:
+            logging.debug("registered: %s", news_item["date"])
 
         logging.info("finished to crawl news")
 
+        return len(registered)
+
     def tweet_news(self, community, limit=0):
-        unprocessed_news = self.get_news_with_community_and_status(
-            community, STATUS_UNPROCESSED)
+        unprocessed_news = self.get_unprocessed_items("news", community)
         tweet_count = 0
+        processed = 0
 
-        logging.info("*** processing news, community: %s unprocessed: %d" %
-                     (community, unprocessed_news.count()))
+        logging.info("*** processing news, community: %s", community)
 
         for news in unprocessed_news:
-            logging.debug("processing news %s" % news["date"])
+            processed += 1
+            logging.debug("processing news %s", news["date"])
+            if not self.can_tweet(community):
+                break
 
             statuses = nicoutil.create_twitter_statuses(
                 u"【お知らせ更新】\n" +
@@ -825,29 +1401,37 @@ class NicoBBS(object):
                 community, statuses, self.update_news_status, news, tweet_count)
 
             if limit and limit <= tweet_count:
-                logging.info("breaking tweet processing, limit: %d tweet_count: %d" %
-                             (limit, tweet_count))
+                logging.info("breaking tweet processing, limit: %d tweet_count: %d",
+                             limit, tweet_count)
                 break
 
-        logging.info("finished to process news")
+        logging.info("finished to process news, processed: %d", processed)
+
+        return tweet_count
 
 # main, video
+    def get_video_page_url(self, community):
+        return COMMUNITY_VIDEO_URL + community
+
     def read_video_page(self, opener, community):
-        url = COMMUNITY_VIDEO_URL + community
-        logging.info("*** reading video page, target: " + url)
+        url = self.get_video_page_url(community)
+        logging.info("*** reading video page, target: %s", url)
 
         reader = opener.open(url)
         rawhtml = reader.read()
         # logging.debug(rawhtml)
         logging.info("finished to read video page.")
 
+        if self.is_page_unchanged(url, reader, rawhtml):
+            return None
+
         return rawhtml
 
     def parse_video(self, rawhtml, community):
-        logging.info("*** parsing community video, community: %s" % community)
+        logging.info("*** parsing community video, community: %s", community)
 
         videos = []
-        soup = BeautifulSoup(rawhtml)
+        soup = nicoutil.parsed_document(rawhtml).soup
         video_tag = soup.find(id="video")
 
         if video_tag:
@@ -862,32 +1446,35 @@ class NicoBBS(object):
                          "status": STATUS_UNPROCESSED}
                 videos.append(video)
 
-        logging.info("scraped %s videos." % len(videos))
+        logging.info("scraped %s videos.", len(videos))
 
         return videos
 
     def store_video(self, videos, community):
-        logging.info("*** crawling video, community: %s" % community)
+        logging.info("*** crawling video, community: %s", community)
 
-        for video in videos:
-            if self.is_video_registered(video):
-                logging.debug("skipped: %s" % video["link"])
-            else:
-                self.register_video(video)
-                logging.debug("registered: %s" % video["link"])
+        registered, skipped = self.register_videos(videos, community)
+        for video in skipped:
+            logging.debug("skipped: %s", video["link"])
+        for video in registered:
+            logging.debug("registered: %s", video["link"])
 
         logging.info("finished to crawl video")
 
+        return len(registered)
+
     def tweet_video(self, community, limit=0):
-        unprocessed_videos = self.get_video_with_community_and_status(
-            community, STATUS_UNPROCESSED)
+        unprocessed_videos = self.get_unprocessed_items("video", community)
         tweet_count = 0
+        processed = 0
 
-        logging.info("*** processing video, community: %s unprocessed: %d" %
-                     (community, unprocessed_videos.count()))
+        logging.info("*** processing video, community: %s", community)
 
         for video in unprocessed_videos:
-            logging.debug("processing video %s" % video["link"])
+            processed += 1
+            logging.debug("processing video %s", video["link"])
+            if not self.can_tweet(community):
+                break
 
             statuses = nicoutil.create_twitter_statuses(
                 u"【コミュ動画投稿】",
@@ -899,111 +1486,350 @@ class NicoBBS(object):
                 community, statuses, self.update_video_status, video, tweet_count)
 
             if limit and limit <= tweet_count:
-                logging.info("breaking tweet processing, limit: %d tweet_count: %d" %
-                             (limit, tweet_count))
+                logging.info("breaking tweet processing, limit: %d tweet_count: %d",
+                             limit, tweet_count)
                 break
 
-        logging.info("finished to process video")
+        logging.info("finished to process video, processed: %d", processed)
+
+        return tweet_count
 
 # kick
-    def kick_bbs(self, opener, community, response_number_prefix="", mark_hashes=[]):
+    def stage_timer(self, community, kind, stage):
+        return self.metrics.timer(STAGE_SECONDS, community=community, kind=kind, stage=stage)
+
+    def count_items(self, community, kind, scraped, registered):
+        self.metrics.increment("items_scraped_total", scraped, community=community, kind=kind)
+        self.metrics.increment("items_registered_total", registered, community=community,
+                               kind=kind)
+
+    def kick_bbs(self, opener, community):
+        found = 0
         try:
-            rawhtml = self.read_response_page(opener, community)
-            responses = self.parse_response(rawhtml, community)
-            self.store_response(responses, community)
-            self.save_bbs_oekaki(opener, community, responses)
-            self.tweet_response(opener, community, response_number_prefix, mark_hashes)
-        except TwitterOverUpdateLimitError:
-            raise
+            with self.stage_timer(community, "bbs", "read"):
+                rawhtml = self.read_response_page(opener, community)
+            if rawhtml is not None:
+                with self.stage_timer(community, "bbs", "parse"):
+                    responses = self.parse_response(rawhtml, community)
+                # the gap pages are timed as read and parse inside
+                responses = self.fill_response_gap(opener, community, responses)
+                # submitted before the responses are visible to the outbox, which waits
+                # only for the pending downloads
+                self.save_bbs_oekaki(opener, community, responses)
+                with self.stage_timer(community, "bbs", "store"):
+                    registered = self.store_response(responses, community)
+                self.count_items(community, "bbs", len(responses), registered)
+                found += registered
+            self.commit_page(self.bbs_internal_urls[community])
         except urllib2.HTTPError, error:
-            logging.error("*** caught http error when processing bbs, error: %s" % error)
+            logging.error("*** caught http error when processing bbs, error: %s", error)
             if error.code == 403:
                 logging.info("bbs is closed?")
         except Exception, error:
-            logging.error("*** caught error when processing bbs, error: %s" % error)
+            logging.error("*** caught error when processing bbs, error: %s", error)
+        return found
 
     def kick_live_news(self, opener, community):
+        has_news = not (self.skip_news[community] or self.is_channel(community))
+        found = 0
         try:
-            rawhtml = self.read_reserved_live_page(opener, community)
-
-            if self.skip_live[community]:
-                logging.info("skipped live.")
-            else:
-                reserved_lives = self.parse_reserved_live(rawhtml, community)
-                self.store_reserved_live(reserved_lives, community)
-                self.tweet_reserved_live(community)
-
-            if self.skip_news[community]:
-                logging.info("skipped news.")
-            else:
-                if self.is_channel(community):
-                    logging.info("channel news is not supported, so skip.")
-                    return
-
-                # use rawhtml above
-                news_items = self.parse_news(rawhtml, community)
-                self.store_news(news_items, community)
-                self.tweet_news(community)
-        except TwitterOverUpdateLimitError:
-            raise
+            with self.stage_timer(community, POLL_LIVE_NEWS, "read"):
+                rawhtml = self.read_reserved_live_page(opener, community)
+
+            # the page is parsed once, and shared by live and news
+            if rawhtml is not None:
+                with self.stage_timer(community, POLL_LIVE_NEWS, "parse"):
+                    document = self.parser.parse_document(rawhtml)
+                    if has_news:
+                        # the news are found with beautifulsoup whichever the parser is
+                        document.soup
+                if not self.skip_live[community]:
+                    with self.stage_timer(community, "live", "parse"):
+                        reserved_lives = self.parse_reserved_live(document, community)
+                    with self.stage_timer(community, "live", "store"):
+                        registered = self.store_reserved_live(reserved_lives, community)
+                    self.count_items(community, "live", len(reserved_lives), registered)
+                    found += registered
+                if has_news:
+                    with self.stage_timer(community, "news", "parse"):
+                        news_items = self.parse_news(document, community)
+                    with self.stage_timer(community, "news", "store"):
+                        registered = self.store_news(news_items, community)
+                    self.count_items(community, "news", len(news_items), registered)
+                    found += registered
+            self.commit_page(self.get_reserved_live_page_url(community))
         except Exception, error:
-            logging.error("*** caught error when processing live/news, error: %s" % error)
+            logging.error("*** caught error when processing live/news, error: %s", error)
+        return found
 
     def kick_video(self, opener, community):
         if self.is_channel(community):
             logging.info("channel video is not supported, so skip.")
+            return 0
+
+        found = 0
+        try:
+            with self.stage_timer(community, "video", "read"):
+                rawhtml = self.read_video_page(opener, community)
+            if rawhtml is not None:
+                with self.stage_timer(community, "video", "parse"):
+                    videos = self.parse_video(rawhtml, community)
+                with self.stage_timer(community, "video", "store"):
+                    registered = self.store_video(videos, community)
+                self.count_items(community, "video", len(videos), registered)
+                found += registered
+            self.commit_page(self.get_video_page_url(community))
+        except Exception, error:
+            logging.error("*** caught error when processing video, error: %s", error)
+        return found
+
+# poll
+    def get_poll_kinds(self, community):
+        kinds = []
+        if not self.skip_bbs[community]:
+            kinds.append(POLL_BBS)
+        if not (self.skip_live[community] and self.skip_news[community]):
+            kinds.append(POLL_LIVE_NEWS)
+        if not (self.skip_video[community] or self.is_channel(community)):
+            kinds.append(POLL_VIDEO)
+        return kinds
+
+    def get_poll_page_url(self, community, kind):
+        if kind == POLL_BBS:
+            return self.get_response_page_url(community)
+        elif kind == POLL_LIVE_NEWS:
+            return self.get_reserved_live_page_url(community)
+        return self.get_video_page_url(community)
+
+    def get_item_timestamps(self, community, kind):
+        timestamps = []
+        for collection in POLL_COLLECTIONS[kind]:
+            timestamps.extend(
+                self.storage.find_timestamps(collection, community, POLL_WARM_ITEMS))
+        return timestamps
+
+    def warm_poll_schedule(self):
+        # the intervals start from the activity seen in the stored items
+        for community in self.target_communities:
+            for kind in self.get_poll_kinds(community):
+                self.poll_schedule.warm(
+                    (community, kind), self.get_item_timestamps(community, kind))
+
+    def get_poll_delay(self):
+        keys = [(community, kind) for community in self.active_communities()
+                for kind in self.get_poll_kinds(community)]
+        return self.poll_schedule.delay(keys)
+
+    def kick(self, opener, community, kind):
+        if kind == POLL_BBS:
+            return self.kick_bbs(opener, community)
+        elif kind == POLL_LIVE_NEWS:
+            return self.kick_live_news(opener, community)
+        return self.kick_video(opener, community)
+
+    def crawl_community(self, opener, community):
+        kinds = [kind for kind in self.get_poll_kinds(community)
+                 if self.poll_schedule.is_due((community, kind))]
+        if not kinds:
             return
 
+        logging.debug(LOG_SEPARATOR)
+        logging.info("*** %s, polling: %s", community, kinds)
+        try:
+            # put the first pages of bbs, live/news and video in flight at once.
+            # read_*_page() below picks them up through the same opener interface.
+            opener.prefetch([self.get_poll_page_url(community, kind) for kind in kinds])
+
+            for kind in kinds:
+                found = self.kick(opener, community, kind)
+                interval = self.poll_schedule.update((community, kind), 0 < found)
+                logging.info("found %d new items in %s, next poll in %d secs.",
+                             found, kind, interval)
+        except Exception, error:
+            logging.error("*** caught error when crawling %s, error: %s", community, error)
+
+    def crawl_cycle(self, pool, opener):
+        engine = nicoutil.FetchEngine(opener, self.fetch_workers)
+        pool.map(lambda community: self.crawl_community(engine, community),
+                 self.active_communities(), 1)
+        engine.close()
+
+# outbox
+    def post_community(self, opener, community):
+        tweet_count = 0
         try:
-            rawhtml = self.read_video_page(opener, community)
-            videos = self.parse_video(rawhtml, community)
-            self.store_video(videos, community)
-            self.tweet_video(community)
+            if not self.skip_bbs[community]:
+                with self.stage_timer(community, "bbs", "tweet"):
+                    tweet_count += self.tweet_response(opener,
+                                                       community,
+                                                       self.response_number_prefix[community],
+                                                       self.mark_hashes[community])
+            if not self.skip_live[community]:
+                with self.stage_timer(community, "live", "tweet"):
+                    tweet_count += self.tweet_reserved_live(community)
+            if not (self.skip_news[community] or self.is_channel(community)):
+                with self.stage_timer(community, "news", "tweet"):
+                    tweet_count += self.tweet_news(community)
+            if not (self.skip_video[community] or self.is_channel(community)):
+                with self.stage_timer(community, "video", "tweet"):
+                    tweet_count += self.tweet_video(community)
         except TwitterOverUpdateLimitError:
-            raise
+            logging.warning("status update over limit, suspending %s for %d secs.",
+                            community, OVER_LIMIT_SUSPEND)
+            self.tweet_bucket(community).suspend(OVER_LIMIT_SUSPEND)
         except Exception, error:
-            logging.error("*** caught error when processing video, error: %s" % error)
+            logging.error("*** caught error when posting %s, error: %s", community, error)
+        return tweet_count
 
-    def start(self):
-        # inifinite loop
+    def process_outbox(self, communities):
+        tweet_count = 0
+        if self.opener is not None and communities:
+            if self.query_all_communities:
+                try:
+                    self.prefetch_unprocessed_items(communities)
+                except Exception, error:
+                    # each community reads its own items instead
+                    logging.error("*** caught error when reading unprocessed items, "
+                                  "error: %s", error)
+            for community in communities:
+                tweet_count += self.post_community(self.opener, community)
+            self.unprocessed_items = {}
+        return tweet_count
+
+    def run_outbox(self):
+        # posts the unprocessed items in the database, apart from the crawl loop. the crawl
+        # loop wakes this up after each cycle, and the statuses left by the accounts without
+        # tokens are picked up again when the tokens are refilled.
+        while True:
+            self.outbox_event.clear()
+            communities = self.active_communities()
+            tweet_count = self.process_outbox(communities)
+
+            timeout = OUTBOX_INTERVAL
+            if tweet_count:
+                timeout = min([self.tweet_bucket(community).delay()
+                               for community in communities] + [timeout])
+            self.outbox_event.wait(timeout)
+
+# archive
+    def archive_items(self):
+        communities = self.active_communities()
+        if not communities:
+            return
+
+        before = datetime.datetime.utcnow() - datetime.timedelta(days=self.archive_after)
+        for (collection, key) in sorted(ITEM_KEYS.items()):
+            archived = self.archiver.archive(
+                self.database[collection], key,
+                {"community": {"$in": communities}, "status": {"$ne": STATUS_UNPROCESSED}},
+                before)
+            logging.info("archived %d items in %s.", archived, collection)
+
+    def run_archiver(self):
         while True:
             try:
-                logging.debug(LOG_SEPARATOR)
-                opener = self.create_opener()
+                self.archive_items()
             except Exception, error:
-                logging.error("*** caught error when creating opener, error : %s" % error)
-            else:
-                for community in self.target_communities:
+                logging.error("*** caught error when archiving items, error: %s", error)
+            time.sleep(self.archive_interval)
+
+# metrics
+    def run_metrics_dump(self):
+        while True:
+            time.sleep(self.metrics_interval)
+            try:
+                self.metrics.dump(self.metrics_dump)
+            except Exception, error:
+                logging.error("*** caught error when dumping metrics, error: %s", error)
+
+    def start_metrics(self):
+        if self.metrics_port:
+            try:
+                nicoutil.serve_metrics(self.metrics, METRICS_HOST, self.metrics_port)
+            except Exception, error:
+                logging.error("*** caught error when serving metrics, error: %s", error)
+        if self.metrics_dump:
+            dump = threading.Thread(target=self.run_metrics_dump, name="metrics_dump")
+            dump.daemon = True
+            dump.start()
+
+# shard
+    def balance_leases(self):
+        try:
+            for community in self.lease_manager.balance(self.target_communities):
+                # another process may have crawled the community while this one did not own it
+                self.last_response_numbers.pop(community, None)
+                self.reply_status_ids.pop(community, None)
+        except Exception, error:
+            logging.error("*** caught error when balancing leases, error: %s", error)
+
+    def run_leases(self):
+        while True:
+            time.sleep(self.lease_heartbeat)
+            self.balance_leases()
+
+    def release_leases(self):
+        # the others take over the communities at once, instead of after lease_ttl
+        try:
+            self.lease_manager.release()
+            logging.info("released all leases.")
+        except Exception, error:
+            logging.error("*** caught error when releasing leases, error: %s", error)
+
+    def start(self):
+        # communities are crawled concurrently, and the requests to the same host are
+        # spaced by the throttle in the opener instead of sleeping after each community.
+        pool = ThreadPool(self.crawl_workers)
+        opener = None
+        self.start_metrics()
+        self.bootstrap_indexes()
+        self.load_pages()
+        self.warm_poll_schedule()
+        self.warm_seen_keys()
+
+        if self.lease_manager is not None:
+            self.balance_leases()
+            leases = threading.Thread(target=self.run_leases, name="leases")
+            leases.daemon = True
+            leases.start()
+
+        outbox = threading.Thread(target=self.run_outbox, name="outbox")
+        outbox.daemon = True
+        outbox.start()
+
+        if self.archiver is not None:
+            archiver = threading.Thread(target=self.run_archiver, name="archiver")
+            archiver.daemon = True
+            archiver.start()
+
+        # inifinite loop, until the process exits
+        try:
+            while True:
+                delay = CRAWL_INTERVAL
+                try:
                     logging.debug(LOG_SEPARATOR)
-                    logging.info("*** " + community)
-                    try:
-                        if self.skip_bbs[community]:
-                            logging.info("skipped bbs.")
-                        else:
-                            self.kick_bbs(opener,
-                                          community,
-                                          self.response_number_prefix[community],
-                                          self.mark_hashes[community])
-
-                        if self.skip_live[community] and self.skip_news[community]:
-                            logging.info("skipped live and news.")
-                        else:
-                            self.kick_live_news(opener, community)
-
-                        if self.skip_video[community]:
-                            logging.info("skipped video.")
-                        else:
-                            self.kick_video(opener, community)
-                    except TwitterOverUpdateLimitError:
-                        logging.warning("status update over limit, so skip.")
-                    logging.debug("*** sleeping %d secs..." % COMMUNITY_INTERVAL)
-                    time.sleep(COMMUNITY_INTERVAL)
-
-            logging.debug(LOG_SEPARATOR)
-            logging.debug("*** sleeping %d secs..." % CRAWL_INTERVAL)
-            time.sleep(CRAWL_INTERVAL)
+                    if opener is None:
+                        opener = self.create_opener()
+                        self.opener = opener
+                except Exception, error:
+                    logging.error("*** caught error when creating opener, error : %s", error)
+                    opener = None
+                else:
+                    self.crawl_cycle(pool, opener)
+                    self.outbox_event.set()
+
+                    # sleep until the next page is due, at least a sec not to spin
+                    delay = min(max(self.get_poll_delay(), 1), CRAWL_INTERVAL)
 
+                logging.debug(LOG_SEPARATOR)
+                logging.debug("*** sleeping %d secs...", delay)
+                time.sleep(delay)
+        finally:
+            if self.lease_manager is not None:
+                self.release_leases()
 
 if __name__ == "__main__":
     nicobbs = NicoBBS()
+    # nicobbs.sh stops the process with TERM, exit through the finally in start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     nicobbs.start()
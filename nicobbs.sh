@@ -11,40 +11,83 @@ pgrep_target="python ${program}"
 monitor_threshold=$((1*60))
 customenv=${basedir}/nicobbs.env
 
+# the workers started together write their own log and cookie file, like log/nicobbs-1.log.
+# a single process is worker 0, and keeps log/nicobbs.log.
+workers() {
+  if [ 1 -lt ${NICOBBS_WORKERS:-1} ]; then
+    seq ${NICOBBS_WORKERS}
+  else
+    echo 0
+  fi
+}
+
+worker_logfile() {
+  if [ "$1" = 0 ]; then
+    echo ${logfile}
+  else
+    echo ${basedir}/log/nicobbs-${1}.log
+  fi
+}
+
 start() {
   if [ 0 -lt $(pgrep -f "${pgrep_target}" | wc -l) ]
   then
     echo "already started."
   else
-    nohup ${program} >> ${nohupfile} 2>&1 &
+    # more than one worker needs shard mode, see nicobbs.config.sample
+    for worker in $(workers)
+    do
+      if [ "${worker}" = 0 ]; then
+        nohup ${program} >> ${nohupfile} 2>&1 &
+      else
+        NICOBBS_WORKER=${worker} nohup ${program} >> ${nohupfile} 2>&1 &
+      fi
+    done
   fi
 }
 
 stop() {
+  # the workers release their leases on TERM, wait for them to exit
   pkill -f "${pgrep_target}" || true
-  echo "killed." >> ${logfile}
+  for i in $(seq 10)
+  do
+    if [ 0 -eq $(pgrep -f "${pgrep_target}" | wc -l) ]; then
+      break
+    fi
+    sleep 1
+  done
+  for worker in $(workers)
+  do
+    echo "killed." >> $(worker_logfile ${worker})
+  done
 }
 
 monitor() {
   echo $(date) monitor start
 
-  if [ ! -e ${logfile} ]; then
-    echo $(date) "log file ${logfile} does not exist."
-    echo $(date) "trying to start application."
-    stop
-    start
-  else
-    last_modified=$(date -r ${logfile} +%s)
-    current=$(date +%s)
+  current=$(date +%s)
+  for worker in $(workers)
+  do
+    worker_log=$(worker_logfile ${worker})
 
+    if [ ! -e ${worker_log} ]; then
+      echo $(date) "log file ${worker_log} does not exist."
+      echo $(date) "trying to start application."
+      stop
+      start
+      break
+    fi
+
+    last_modified=$(date -r ${worker_log} +%s)
     if [ $((${last_modified} + ${monitor_threshold})) -lt ${current} ]
     then
-      echo $(date) "log file ${logfile} has not been updated for ${monitor_threshold} seconds."
+      echo $(date) "log file ${worker_log} has not been updated for ${monitor_threshold} seconds."
       echo $(date) "trying to restart application."
       stop
       start
+      break
     fi
-  fi
+  done
 
   echo $(date) monitor end
 }
@@ -1 +1,13 @@
 from nicoutil.util import *
+from nicoutil.network import *
+from nicoutil.parser import *
+from nicoutil.cache import *
+from nicoutil.spam import *
+from nicoutil.lease import *
+from nicoutil.schedule import *
+from nicoutil.index import *
+from nicoutil.archive import *
+from nicoutil.download import *
+from nicoutil.metrics import *
+from nicoutil.storage import *
+from nicoutil.log import *
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import logging
+import os
+
+from bson import json_util
+from bson.objectid import ObjectId
+import pymongo
+
+from nicoutil.index import list_collection_names
+
+ARCHIVE_SUFFIX = "_archive"
+ARCHIVE_BATCH_SIZE = 1000
+# archive collections are compressed harder than the hot ones, only on wiredtiger
+ARCHIVE_STORAGE_ENGINE = {"wiredTiger": {"configString": "block_compressor=zlib"}}
+
+
+class Archiver(object):
+    # magic methods
+    def __init__(self, lookup, archive_dir=None, batch_size=ARCHIVE_BATCH_SIZE):
+        # lookup keeps {_id, collection, community, key, status_id} of the archived documents
+        self.lookup = lookup
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+
+    # internal methods
+    def archive_collection(self, collection):
+        database = collection.database
+        name = collection.name + ARCHIVE_SUFFIX
+        if name not in list_collection_names(database):
+            try:
+                database.create_collection(name, storageEngine=ARCHIVE_STORAGE_ENGINE)
+            except pymongo.errors.PyMongoError, error:
+                logging.warning("could not create compressed collection %s: %s", name, error)
+        return database[name]
+
+    def write_file(self, collection, documents):
+        # gzip members are appended, and the file is read as one gzip stream
+        if not os.path.exists(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        path = os.path.join(self.archive_dir, collection.name + ARCHIVE_SUFFIX + ".json.gz")
+        archive = gzip.open(path, "ab")
+        try:
+            for document in documents:
+                archive.write(json.dumps(document, default=json_util.default) + "\n")
+        finally:
+            archive.close()
+
+    def insert_documents(self, collection, documents):
+        # returns the ids stored in the collection. the writes are acknowledged, and the
+        # duplicates are the documents stored by an interrupted batch already.
+        ids = [document["_id"] for document in documents]
+        try:
+            collection.insert(documents, safe=True, continue_on_error=True)
+            return set(ids)
+        except pymongo.errors.DuplicateKeyError:
+            # only the last error is reported, so look up what is stored
+            return set([document["_id"] for document in collection.find(
+                {"_id": {"$in": ids}}, fields=["_id"])])
+
+    def write_lookup(self, collection, key, documents):
+        return self.insert_documents(self.lookup, [
+            {"_id": document["_id"],
+             "collection": collection.name,
+             "community": document.get("community"),
+             "key": document.get(key),
+             "status_id": document.get("status_id", 0)} for document in documents])
+
+    # public methods
+    def archive(self, collection, key, query, before):
+        # moves the documents matching the query and inserted before the utc datetime, in
+        # batches; archive, lookup, then remove the documents whose writes are acknowledged,
+        # so an interrupted batch is moved again.
+        query = dict(query)
+        query["_id"] = {"$lt": ObjectId.from_datetime(before)}
+        archived = 0
+
+        while True:
+            documents = list(collection.find(query, limit=self.batch_size, sort=[("_id", 1)]))
+            if not documents:
+                break
+
+            if self.archive_dir:
+                self.write_file(collection, documents)
+                stored_ids = set([document["_id"] for document in documents])
+            else:
+                stored_ids = self.insert_documents(self.archive_collection(collection),
+                                                   documents)
+            stored_ids &= self.write_lookup(collection, key, [
+                document for document in documents if document["_id"] in stored_ids])
+            if stored_ids:
+                collection.remove({"_id": {"$in": list(stored_ids)}}, safe=True)
+
+            archived += len(stored_ids)
+            if len(stored_ids) < len(documents):
+                # the rest would be found again by the next batch
+                logging.error("could not archive %d documents of %s.",
+                              len(documents) - len(stored_ids), collection.name)
+                break
+            if len(documents) < self.batch_size:
+                break
+
+        return archived
+
+
+if __name__ == "__main__":
+    pass
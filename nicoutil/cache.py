@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import datetime
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class LRUCache(object):
+    # magic methods
+    def __init__(self, capacity, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.items)
+
+    # public methods
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires <= time.time():
+                return default
+            # move to the most recently used position
+            self.items[key] = item
+            return value
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, expires)
+            while self.capacity < len(self.items):
+                self.items.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class MetadataCache(object):
+    # magic methods
+    def __init__(self, capacity, ttl, negative_ttl, collection=None, workers=4):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = LRUCache(capacity)
+        self.collection = collection
+        self.pool = ThreadPool(workers)
+
+    # internal methods
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.collection is None:
+            return value
+
+        document = self.collection.find_one(
+            {"_id": key, "expires": {"$gt": datetime.datetime.utcnow()}})
+        if document is None:
+            return None
+        remaining = document["expires"] - datetime.datetime.utcnow()
+        self.memory.put(key, document["value"], remaining.total_seconds())
+        return document["value"]
+
+    def put(self, key, value, ttl):
+        self.memory.put(key, value, ttl)
+        if self.collection is not None:
+            expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+            self.collection.update(
+                {"_id": key}, {"$set": {"value": value, "expires": expires}}, True)
+
+    # public methods
+    def lookup(self, keys, fetch):
+        # fetch(key) returns (value, failed), failed values are cached with negative_ttl
+        values = {}
+        misses = []
+        for key in keys:
+            value = self.get(key)
+            if value is None:
+                misses.append(key)
+            else:
+                values[key] = value
+
+        if 1 < len(misses):
+            results = self.pool.map(fetch, misses, 1)
+        else:
+            results = [fetch(key) for key in misses]
+
+        for key, (value, failed) in zip(misses, results):
+            self.put(key, value, self.negative_ttl if failed else self.ttl)
+            values[key] = value
+
+        return values
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PARTIAL_SUFFIX = ".part"
+
+
+class Downloader(object):
+    # magic methods
+    def __init__(self, workers, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        self.pool = ThreadPool(workers)
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    # internal methods
+    def download(self, opener, url, path):
+        # the body is written to the partial file and renamed at the end, so the file at
+        # the path is always complete.
+        partial_path = path + PARTIAL_SUFFIX
+        try:
+            response = opener.open_stream(url)
+            try:
+                local = open(partial_path, 'wb')
+                try:
+                    for chunk in response.iter_content(self.chunk_size):
+                        local.write(chunk)
+                finally:
+                    local.close()
+            finally:
+                response.close()
+            os.rename(partial_path, path)
+            logging.debug("downloaded %s to %s", url, path)
+        except Exception, error:
+            logging.error("*** caught error when downloading %s, error: %s", url, error)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    # public methods
+    def submit(self, opener, url, path):
+        # the files already on the disk, or being downloaded, are skipped
+        with self.lock:
+            if path in self.pending or os.path.exists(path):
+                return False
+            self.pending[path] = self.pool.apply_async(self.download, (opener, url, path))
+        return True
+
+    def wait(self, path, timeout=None):
+        # returns whether the file is ready, after waiting for the pending download
+        with self.lock:
+            result = self.pending.get(path)
+        if result is not None:
+            result.wait(timeout)
+        return os.path.exists(path)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+
+from bson.son import SON
+import pymongo
+
+OPTION_NAMES = ["unique", "partialFilterExpression", "expireAfterSeconds"]
+
+
+# internal methods
+def index_name(keys, options):
+    name = "_".join(["%s_%s" % (key, direction) for (key, direction) in keys])
+    if options.get("unique"):
+        name += "_unique"
+    if "partialFilterExpression" in options:
+        name += "_partial"
+    return name
+
+
+def normalize_keys(keys):
+    # indexes created in the mongo shell have the directions in float, like 1.0. the keys
+    # listed by the command are in a SON.
+    if hasattr(keys, "items"):
+        keys = keys.items()
+    return [(key, int(direction)) for (key, direction) in keys]
+
+
+def is_same_index(index, keys, options):
+    if normalize_keys(index["key"]) != normalize_keys(keys):
+        return False
+    for option in OPTION_NAMES:
+        if index.get(option) != options.get(option):
+            return False
+    return True
+
+
+# public methods
+def list_indexes(collection):
+    # returns {name: index}. index_information() of pymongo 2.2 reads system.indexes, which
+    # is empty on wiredtiger, so the command of mongo 3.0+ is used instead.
+    try:
+        result = collection.database.command("listIndexes", collection.name, as_class=SON)
+    except pymongo.errors.OperationFailure:
+        # the older servers, or the collection does not exist yet
+        return collection.index_information()
+    return dict([(index["name"], index) for index in result["cursor"]["firstBatch"]])
+
+
+def list_collection_names(database):
+    # collection_names() of pymongo 2.2 reads system.namespaces, empty on wiredtiger too
+    try:
+        result = database.command("listCollections")
+    except pymongo.errors.OperationFailure:
+        return database.collection_names()
+    return [collection["name"] for collection in result["cursor"]["firstBatch"]]
+
+
+def bootstrap_indexes(collection, indexes, obsolete_names=()):
+    # creates the indexes [(keys, options), ...] that do not exist yet. the obsolete ones,
+    # and the ones with the same keys but with the other options are dropped beforehand.
+    existing = list_indexes(collection)
+    names = [index_name(keys, options) for (keys, options) in indexes]
+
+    for name in obsolete_names:
+        if name in existing:
+            collection.drop_index(name)
+            del existing[name]
+            logging.info("dropped obsolete index %s.%s", collection.name, name)
+
+    for (name, (keys, options)) in zip(names, indexes):
+        if name in existing and is_same_index(existing[name], keys, options):
+            continue
+
+        fallback_name = name + "_fallback"
+        if fallback_name in existing:
+            logging.warning("unique index %s.%s is replaced by %s for the duplicate keys, "
+                            "drop it to try again after removing them.",
+                            collection.name, name, fallback_name)
+            continue
+
+        for (other_name, other) in existing.items():
+            if other_name == name or (other_name not in names and
+                                      normalize_keys(other["key"]) == normalize_keys(keys)):
+                collection.drop_index(other_name)
+                del existing[other_name]
+                logging.info("dropped index %s.%s", collection.name, other_name)
+
+        try:
+            collection.create_index(keys, name=name, **options)
+        except pymongo.errors.OperationFailure, error:
+            if not options.get("unique"):
+                raise
+            # typically the duplicate keys stored before the unique index, the lookups are
+            # kept indexed until they are removed.
+            logging.error("could not create unique index %s.%s: %s",
+                          collection.name, name, error)
+            options = dict([(option, value) for (option, value) in options.items()
+                            if option != "unique"])
+            name = fallback_name
+            collection.create_index(keys, name=name, **options)
+        logging.info("created index %s.%s", collection.name, name)
+
+
+if __name__ == "__main__":
+    pass
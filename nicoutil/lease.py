@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import math
+import os
+import socket
+import threading
+
+import pymongo
+
+EXPIRED = datetime.datetime(1970, 1, 1)
+
+
+# public methods
+def default_owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class LeaseManager(object):
+    # magic methods
+    def __init__(self, leases, workers, owner, ttl):
+        # leases: {_id: key, owner: owner, expires: utc datetime}
+        # workers: {_id: owner, expires: utc datetime}, the live workers share the keys
+        self.leases = leases
+        self.workers = workers
+        self.owner = owner
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.held_keys = set()
+        # utc datetime of the last balance that renewed the held leases
+        self.renewed = EXPIRED
+
+    # internal methods
+    def expires(self, now):
+        return now + datetime.timedelta(seconds=self.ttl)
+
+    def count_workers(self, now):
+        self.workers.update({"_id": self.owner}, {"$set": {"expires": self.expires(now)}}, True)
+        return max(self.workers.find({"expires": {"$gt": now}}).count(), 1)
+
+    def renew(self, keys, now):
+        held = list(self.held_keys)
+        if held:
+            self.leases.update({"_id": {"$in": held}, "owner": self.owner},
+                               {"$set": {"expires": self.expires(now)}}, multi=True)
+        # the leases expired before this heartbeat may have been taken over by the others
+        return set([lease["_id"] for lease in self.leases.find(
+            {"_id": {"$in": keys}, "owner": self.owner, "expires": {"$gt": now}}, fields=["_id"])])
+
+    def claim(self, key, now):
+        # the lease held by another worker does not match the query, and the upsert fails
+        # with the duplicate key.
+        try:
+            self.leases.find_and_modify(
+                {"_id": key, "expires": {"$lte": now}},
+                {"$set": {"owner": self.owner, "expires": self.expires(now)}},
+                upsert=True)
+        except pymongo.errors.OperationFailure:
+            return False
+        return True
+
+    def release_keys(self, keys):
+        self.leases.update({"_id": {"$in": list(keys)}, "owner": self.owner},
+                           {"$set": {"expires": EXPIRED}}, multi=True)
+
+    # public methods
+    def balance(self, keys):
+        # renews the held leases, hands over the ones beyond the share of this worker, and
+        # claims the free or expired ones up to the share. returns the newly claimed keys.
+        with self.lock:
+            now = datetime.datetime.utcnow()
+            share = int(math.ceil(float(len(keys)) / self.count_workers(now)))
+            held = self.renew(keys, now)
+
+            extras = [key for key in keys if key in held][share:]
+            if extras:
+                self.release_keys(extras)
+                held.difference_update(extras)
+                logging.info("released leases: %s", extras)
+
+            claimed = []
+            for key in keys:
+                if share <= len(held):
+                    break
+                if key not in held and self.claim(key, now):
+                    held.add(key)
+                    claimed.append(key)
+            if claimed:
+                logging.info("claimed leases: %s", claimed)
+
+            self.held_keys = held
+            self.renewed = now
+            return claimed
+
+    def held(self, keys):
+        with self.lock:
+            # without heartbeats, like when the database is unreachable, the leases expire
+            # and may be owned by the others already
+            if self.held_keys and self.expires(self.renewed) <= datetime.datetime.utcnow():
+                logging.warning("leases are not renewed for %d secs, dropped: %s",
+                                self.ttl, sorted(self.held_keys))
+                self.held_keys = set()
+            return [key for key in keys if key in self.held_keys]
+
+    def release(self):
+        with self.lock:
+            self.release_keys(self.held_keys)
+            self.held_keys = set()
+            self.workers.remove({"_id": self.owner})
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import Queue
+import sys
+import threading
+
+# records waiting for the writer thread, the newer ones are dropped when it is full
+LOG_QUEUE_SIZE = 10000
+# types of the arguments that are formatted in the writer thread, the others may change
+# after the call, so the message is formatted when the record is queued.
+IMMUTABLE_ARG_TYPES = (basestring, int, long, float, bool, type(None))
+
+# callable that returns the fields of the current thread, like the community and the stage
+_context_provider = None
+
+
+# public methods
+def set_log_context(provider):
+    global _context_provider
+    _context_provider = provider
+
+
+def get_log_context():
+    if _context_provider is None:
+        return {}
+    return _context_provider()
+
+
+def is_debug_enabled():
+    # guard for the debug messages whose arguments are costly to build
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def add_log_context(record):
+    # the context is taken in the thread that logs, not in the writer thread
+    if not hasattr(record, "context"):
+        record.context = get_log_context()
+    return record
+
+
+class JSONFormatter(logging.Formatter):
+    # one json object per line, with the fields of the log context
+    # public methods
+    def format(self, record):
+        add_log_context(record)
+        document = {"time": self.formatTime(record, self.datefmt),
+                    "level": record.levelname,
+                    "thread": record.threadName,
+                    "logger": record.name,
+                    "message": record.getMessage()}
+        document.update(record.context)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            document["exception"] = record.exc_text
+        return json.dumps(document, sort_keys=True)
+
+
+class AsyncHandler(logging.Handler):
+    # hands the records to the target handler in a writer thread, so the callers never
+    # wait for the disk. python 2.7 has no QueueHandler/QueueListener.
+    # magic methods
+    def __init__(self, target, capacity=LOG_QUEUE_SIZE, block=False):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.block = block
+        self.queue = Queue.Queue(capacity)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.write_records, name="log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # internal methods
+    def prepare(self, record):
+        add_log_context(record)
+        if record.args and not (isinstance(record.args, tuple) and all(
+                [isinstance(arg, IMMUTABLE_ARG_TYPES) for arg in record.args])):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # tracebacks keep the frames alive, format them now
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def write_records(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    break
+                if record.levelno >= self.target.level:
+                    self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+            finally:
+                self.queue.task_done()
+
+    # public methods
+    def setFormatter(self, formatter):
+        # the records are formatted by the target, in the writer thread
+        logging.Handler.setFormatter(self, formatter)
+        self.target.setFormatter(formatter)
+
+    def emit(self, record):
+        try:
+            self.queue.put(self.prepare(record), self.block)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        # waits for the queued records to be written
+        if self.thread.is_alive():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.dropped:
+            sys.stderr.write("dropped %d log records, the log queue was full.\n" % self.dropped)
+        self.target.close()
+        logging.Handler.close(self)
+
+
+if __name__ == "__main__":
+    pass
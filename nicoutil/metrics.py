@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import BaseHTTPServer
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+# upper bounds in secs of the latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# pymongo collection methods that make a round trip to the server, find is counted once
+# for the query, and not for each batch of the cursor
+ROUND_TRIP_METHODS = ["find", "find_one", "insert", "save", "update", "remove",
+                      "find_and_modify", "count", "distinct", "aggregate", "create_index",
+                      "drop_index", "index_information"]
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+# counter of the database round trips, by the collection, the operation and the timer labels
+ROUND_TRIPS = "db_round_trips_total"
+
+TYPE_COUNTER = "counter"
+TYPE_HISTOGRAM = "histogram"
+
+
+class Histogram(object):
+    # magic methods
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    # public methods
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class Metrics(object):
+    # magic methods
+    def __init__(self, namespace, buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+        self.local = threading.local()
+
+    # internal methods
+    def key(self, name, metric_type, labels):
+        # called with the lock held
+        self.types.setdefault(name, metric_type)
+        return (name, tuple(sorted(labels.items())))
+
+    def format_labels(self, labels, extra=()):
+        pairs = ['%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                 for (label, value) in list(labels) + list(extra)]
+        return "{%s}" % ",".join(pairs) if pairs else ""
+
+    # public methods
+    def increment(self, name, value=1, **labels):
+        with self.lock:
+            key = self.key(name, TYPE_COUNTER, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self.key(name, TYPE_HISTOGRAM, labels)
+            if key not in self.values:
+                self.values[key] = Histogram(self.buckets)
+            self.values[key].observe(value)
+
+    def context(self):
+        # labels of the timers running in the current thread
+        return dict(getattr(self.local, "labels", {}))
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def snapshot(self):
+        with self.lock:
+            items = sorted(self.values.items())
+            metrics = {}
+            for ((name, labels), value) in items:
+                sample = {"labels": dict(labels)}
+                if isinstance(value, Histogram):
+                    sample.update({"sum": value.sum, "count": value.count,
+                                   "buckets": dict(zip([str(bound) for bound in self.buckets] +
+                                                       ["+Inf"], value.cumulative_counts()))})
+                else:
+                    sample["value"] = value
+                metrics.setdefault(name, {"type": self.types[name], "samples": []})
+                metrics[name]["samples"].append(sample)
+        return {"time": time.time(), "metrics": metrics}
+
+    def render(self):
+        # prometheus text exposition format
+        lines = []
+        with self.lock:
+            items = sorted(self.values.items())
+            for (index, ((name, labels), value)) in enumerate(items):
+                full_name = self.namespace + "_" + name
+                if index == 0 or items[index - 1][0][0] != name:
+                    lines.append("# TYPE %s %s" % (full_name, self.types[name]))
+                if isinstance(value, Histogram):
+                    bounds = [repr(bound) for bound in self.buckets] + ["+Inf"]
+                    for (bound, count) in zip(bounds, value.cumulative_counts()):
+                        lines.append("%s_bucket%s %d" % (
+                            full_name, self.format_labels(labels, [("le", bound)]), count))
+                    lines.append("%s_sum%s %r" % (full_name, self.format_labels(labels),
+                                                  value.sum))
+                    lines.append("%s_count%s %d" % (full_name, self.format_labels(labels),
+                                                    value.count))
+                else:
+                    lines.append("%s%s %r" % (full_name, self.format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        # written to a temporary file and renamed, so the readers never see a partial file
+        temporary_path = path + ".tmp"
+        f = open(temporary_path, "w")
+        try:
+            json.dump(self.snapshot(), f, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(temporary_path, path)
+
+
+class Timer(object):
+    # observes the secs spent in the with block, and puts the labels in the context of
+    # the thread meanwhile, see Metrics.context().
+    # magic methods
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.previous = None
+        self.start = 0
+
+    def __enter__(self):
+        local = self.metrics.local
+        self.previous = getattr(local, "labels", {})
+        local.labels = dict(self.previous, **self.labels)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.start, **self.labels)
+        self.metrics.local.labels = self.previous
+        return False
+
+
+class InstrumentedCollection(object):
+    # counts the round trips of a pymongo collection with the labels of the running timers
+    # magic methods
+    def __init__(self, collection, metrics, name):
+        self.collection = collection
+        self.metrics = metrics
+        self.name = name
+
+    def __getattr__(self, attribute):
+        value = getattr(self.collection, attribute)
+        if attribute in ROUND_TRIP_METHODS:
+            return self.counted(value, attribute)
+        return value
+
+    # internal methods
+    def counted(self, method, operation):
+        def call(*args, **kwargs):
+            labels = self.metrics.context()
+            labels.update({"collection": self.collection.name, "operation": operation})
+            self.metrics.increment(self.name, **labels)
+            return method(*args, **kwargs)
+        return call
+
+
+class InstrumentedDatabase(object):
+    # magic methods
+    def __init__(self, database, metrics, name=ROUND_TRIPS):
+        self.database = database
+        self.metrics = metrics
+        self.name = name
+
+    def __getattr__(self, attribute):
+        if attribute.startswith("_"):
+            return getattr(self.database, attribute)
+        return self[attribute]
+
+    def __getitem__(self, collection):
+        return InstrumentedCollection(self.database[collection], self.metrics, self.name)
+
+    # public methods
+    def collection_names(self):
+        return self.database.collection_names()
+
+    def create_collection(self, name, **kwargs):
+        return self.database.create_collection(name, **kwargs)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path.split("?")[0] == "/metrics.json":
+            body = json.dumps(metrics.snapshot(), sort_keys=True)
+            content_type = "application/json"
+        elif self.path.split("?")[0] in ["/", "/metrics"]:
+            body = metrics.render()
+            content_type = PROMETHEUS_CONTENT_TYPE
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# public methods
+def serve_metrics(metrics, host, port):
+    # serves /metrics in the prometheus format and /metrics.json on a daemon thread
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    logging.info("serving metrics on http://%s:%d/metrics", host, server.server_port)
+    return server
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import cookielib
+import hashlib
+import logging
+import os
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+import requests
+
+# niconico tells whether the request is authenticated with this header, '0' means logged out
+AUTHFLAG_HEADER = 'x-niconico-authflag'
+# cookie of the logged in session
+SESSION_COOKIE = 'user_session'
+
+
+class HostThrottle(object):
+    # magic methods
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slots = {}
+
+    # public methods
+    def wait(self, url):
+        host = urlparse.urlparse(url).netloc
+
+        # reserve the next slot for the host, then sleep outside of the lock so that
+        # requests to the other hosts are not blocked.
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slots.get(host, 0))
+            self.next_slots[host] = slot + self.interval
+
+        delay = slot - now
+        if 0 < delay:
+            time.sleep(delay)
+
+
+class TokenBucket(object):
+    # magic methods
+    def __init__(self, capacity, rate, interval=0):
+        # up to capacity tokens, refilled by rate tokens per sec, taken at least interval apart
+        self.capacity = capacity
+        self.rate = rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.next_slot = 0
+        self.suspended_until = 0
+
+    # internal methods
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def locked_delay(self, now):
+        self.refill(now)
+        delay = max(self.next_slot, self.suspended_until) - now
+        if self.tokens < 1:
+            delay = max(delay, (1 - self.tokens) / self.rate)
+        return max(delay, 0)
+
+    # public methods
+    def delay(self):
+        with self.lock:
+            return self.locked_delay(time.time())
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                delay = self.locked_delay(now)
+                if delay <= 0:
+                    self.tokens -= 1
+                    self.next_slot = now + self.interval
+                    return
+            time.sleep(delay)
+
+    def suspend(self, secs):
+        # drain the bucket, no tokens are handed out for secs
+        with self.lock:
+            now = time.time()
+            self.refill(now)
+            self.tokens = 0
+            self.suspended_until = now + secs
+
+
+class PageValidators(object):
+    # magic methods
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.staged = {}
+
+    # public methods
+    def load(self, url, etag=None, last_modified=None, digest=None):
+        with self.lock:
+            self.pages[url] = {"etag": etag, "last_modified": last_modified, "digest": digest}
+
+    def headers(self, url):
+        with self.lock:
+            page = self.pages.get(url)
+
+        headers = {}
+        if page:
+            if page["etag"]:
+                headers['If-None-Match'] = page["etag"]
+            if page["last_modified"]:
+                headers['If-Modified-Since'] = page["last_modified"]
+        return headers
+
+    def is_unchanged(self, url, reader, body):
+        if reader.getcode() == 304:
+            return True
+
+        info = reader.info()
+        page = {"etag": info.get('etag'),
+                "last_modified": info.get('last-modified'),
+                "digest": hashlib.sha1(body).hexdigest()}
+
+        # new validators are staged until the page is processed, see commit()
+        with self.lock:
+            current = self.pages.get(url)
+            self.staged[url] = page
+        return current is not None and current["digest"] == page["digest"]
+
+    def commit(self, url):
+        with self.lock:
+            page = self.staged.pop(url, None)
+            if page:
+                self.pages[url] = page
+        return page
+
+
+class NicoSession(object):
+    # magic methods
+    def __init__(self, login_url, mail, password, cookie_file, throttle, pool_size,
+                 validators=None, metrics=None):
+        self.login_url = login_url
+        self.mail = mail
+        self.password = password
+        self.cookie_file = cookie_file
+        self.throttle = throttle
+        self.validators = validators
+        self.metrics = metrics
+
+        # keep-alive connections are pooled per host by the adapter
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.login_lock = threading.Lock()
+        self.login_count = 0
+
+        self.load_cookies()
+
+    # internal methods
+    def load_cookies(self):
+        if not os.path.exists(self.cookie_file):
+            return
+        cookiejar = cookielib.LWPCookieJar(self.cookie_file)
+        try:
+            cookiejar.load(ignore_discard=True, ignore_expires=True)
+        except (IOError, cookielib.LoadError), error:
+            logging.warning("could not load cookie file %s: %s", self.cookie_file, error)
+            return
+        for cookie in cookiejar:
+            self.session.cookies.set_cookie(cookie)
+        logging.info("loaded %d cookies from %s", len(cookiejar), self.cookie_file)
+
+    def save_cookies(self):
+        cookiejar = cookielib.LWPCookieJar(self.cookie_file)
+        for cookie in self.session.cookies:
+            cookiejar.set_cookie(cookie)
+        cookiejar.save(ignore_discard=True, ignore_expires=True)
+        os.chmod(self.cookie_file, 0600)
+
+    def request(self, url, data=None):
+        self.throttle.wait(url)
+        if data is None:
+            headers = self.validators.headers(url) if self.validators else {}
+            response = self.session.get(url, headers=headers)
+        else:
+            response = self.session.post(url, data=data)
+        self.record(url, response, len(response.content))
+        return response
+
+    def record(self, url, response, size):
+        if self.metrics is None:
+            return
+        host = urlparse.urlparse(url).netloc
+        self.metrics.increment("http_requests_total", host=host, code=response.status_code)
+        self.metrics.increment("http_bytes_total", size, host=host)
+
+    def raise_for_status(self, url, response):
+        if 400 <= response.status_code:
+            raise urllib2.HTTPError(url, response.status_code, response.reason,
+                                    response.headers, None)
+
+    def is_logged_out(self, response):
+        return (response.headers.get(AUTHFLAG_HEADER) == '0' or
+                response.url.startswith(self.login_url))
+
+    # public methods
+    def has_cookies(self):
+        # the expired cookies are loaded from the cookie file too, they need a login
+        return any([cookie.name == SESSION_COOKIE and not cookie.is_expired()
+                    for cookie in self.session.cookies])
+
+    def login(self, login_count=None):
+        with self.login_lock:
+            # another thread has already logged in again while this thread was waiting
+            if login_count is not None and login_count != self.login_count:
+                return
+            self.request(self.login_url, {'mail': self.mail, 'password': self.password})
+            self.login_count += 1
+            self.save_cookies()
+            logging.info("finished login")
+
+    def open(self, url, data=None):
+        login_count = self.login_count
+        response = self.request(url, data)
+
+        if data is None and self.is_logged_out(response):
+            logging.info("session expired, trying to login again.")
+            self.login(login_count)
+            response = self.request(url, data)
+
+        self.raise_for_status(url, response)
+        return urllib.addinfourl(StringIO(response.content), response.headers,
+                                 response.url, response.status_code)
+
+    def open_stream(self, url):
+        # the body is not read here, iterate response.iter_content() and close() it
+        self.throttle.wait(url)
+        response = self.session.get(url, stream=True)
+        self.record(url, response, int(response.headers.get('content-length') or 0))
+        if 400 <= response.status_code:
+            response.close()
+            self.raise_for_status(url, response)
+        return response
+
+
+class FetchEngine(object):
+    # magic methods
+    def __init__(self, opener, workers):
+        self.opener = opener
+        self.pool = ThreadPool(workers)
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    # internal methods
+    def fetch(self, url):
+        reader = self.opener.open(url)
+        body = reader.read()
+        return urllib.addinfourl(StringIO(body), reader.info(), reader.geturl(), reader.getcode())
+
+    # public methods
+    def prefetch(self, urls):
+        with self.lock:
+            for url in urls:
+                if url not in self.pending:
+                    self.pending[url] = self.pool.apply_async(self.fetch, (url,))
+
+    def open(self, url, data=None):
+        # prefetched pages are handed out only once, so the next open() reads the page again
+        if data is None:
+            with self.lock:
+                result = self.pending.pop(url, None)
+            if result is not None:
+                return result.get()
+        return self.opener.open(url, data)
+
+    def open_stream(self, url):
+        return self.opener.open_stream(url)
+
+    def fetch_all(self, urls):
+        self.prefetch(urls)
+        return [self.open(url).read() for url in urls]
+
+    def close(self):
+        with self.lock:
+            self.pending = {}
+        self.pool.close()
+        self.pool.join()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from bs4 import BeautifulSoup
+import lxml.etree
+import lxml.html
+
+PARSER_SOUP = 'beautifulsoup'
+PARSER_LXML = 'lxml'
+
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+# lxml parser objects must not be shared between threads
+thread_local = threading.local()
+
+
+# internal methods
+def xpath_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+def collapse_space(text):
+    # same as beautifulsoup, whitespace-only strings are collapsed into a newline or a space
+    if text and not text.strip(ASCII_SPACES):
+        return u"\n" if u"\n" in text else u" "
+    return text
+
+
+def collapse_spaces(element):
+    for child in element.iterdescendants():
+        child.text = collapse_space(child.text)
+        child.tail = collapse_space(child.tail)
+    element.text = collapse_space(element.text)
+    return element
+
+
+def lxml_html_parser():
+    if not hasattr(thread_local, 'html_parser'):
+        thread_local.html_parser = lxml.html.HTMLParser(encoding='utf-8')
+    return thread_local.html_parser
+
+
+# document
+class ParsedDocument(object):
+    # magic methods
+    def __init__(self, rawhtml):
+        self.rawhtml = rawhtml
+        self.soup_tree = None
+        self.lxml_tree = None
+
+    # public methods
+    @property
+    def soup(self):
+        if self.soup_tree is None:
+            self.soup_tree = BeautifulSoup(self.rawhtml)
+        return self.soup_tree
+
+    @property
+    def lxml(self):
+        if self.lxml_tree is None:
+            if isinstance(self.rawhtml, unicode):
+                self.lxml_tree = lxml.html.document_fromstring(self.rawhtml)
+            else:
+                self.lxml_tree = lxml.html.document_fromstring(
+                    self.rawhtml, parser=lxml_html_parser())
+        return self.lxml_tree
+
+
+def parsed_document(rawhtml):
+    if isinstance(rawhtml, ParsedDocument):
+        return rawhtml
+    return ParsedDocument(rawhtml)
+
+
+# parsers
+#   all of the parsers take a raw html or a ParsedDocument, and return the same raw values
+#   for the nicobbs to filter them as before.
+#   - extract_responses: [(number, name, head_text, body_html), ...]
+#   - extract_community_name: community_name
+#   - extract_reserved_lives: [(title, link, date), ...]
+class SoupParser(object):
+    # public methods
+    def parse_document(self, rawhtml):
+        # builds the tree now, for the parse to be timed where it happens
+        document = parsed_document(rawhtml)
+        document.soup
+        return document
+
+    def extract_responses(self, rawhtml, last_number=0):
+        soup = parsed_document(rawhtml).soup
+        resheads = soup.findAll("dt", {"class": "reshead"})
+        resbodies = soup.findAll("dd", {"class": "resbody"})
+        responses = []
+
+        for index, reshead in enumerate(resheads):
+            number = reshead.find("a", {"class": "resnumhead"})["name"]
+            if int(number) <= last_number:
+                continue
+            name = reshead.find("span", {"class": "name"}).text.strip()
+            head_text = reshead.text.strip()
+            body = "".join([unicode(x) for x in resbodies[index]]).strip()
+            responses.append((number, name, head_text, body))
+
+        return responses
+
+    def extract_community_name(self, rawhtml, is_channel):
+        soup = parsed_document(rawhtml).soup
+
+        if is_channel:
+            return soup.find("h1", {"class": "channel_name"}).text
+        else:
+            return soup.find("h1", {"id": "community_name"}).text
+
+    def extract_reserved_lives(self, rawhtml, is_channel):
+        soup = parsed_document(rawhtml).soup
+        reserved_lives = []
+
+        if is_channel:
+            section = soup.find("section", {"class": "future"})
+            if section:
+                lives = section.find_all("div", {"class": "item_right"})
+                for live in lives:
+                    title = live.find("h6", {"class": "title"})
+                    link = title.find("a")["href"]
+                    date = live.find("p", {"class": "date"}).text
+                    reserved_lives.append((title.text, link, date))
+        else:
+            lives = soup.findAll("div", {"class": "item"})
+            for live in lives:
+                date = live.find("p", {"class": "date"})
+                title = live.find("p", {"class": "title"})
+                if title:
+                    anchor = title.find("a")
+                    reserved_lives.append((anchor.text, anchor["href"], date.text))
+
+        return reserved_lives
+
+
+class LxmlParser(object):
+    # internal methods
+    def inner_html(self, element):
+        # serialize as xml to keep the markup same as beautifulsoup, like '<br/>'. the
+        # strings directly in the element are raw like bs4 NavigableString, and only the
+        # strings inside the child tags are escaped.
+        html = [element.text or u""]
+        for child in element:
+            html.append(lxml.etree.tostring(child, encoding=unicode, method="xml",
+                                            with_tail=False))
+            html.append(child.tail or u"")
+        return u"".join(html)
+
+    # public methods
+    def parse_document(self, rawhtml):
+        document = parsed_document(rawhtml)
+        document.lxml
+        return document
+
+    def extract_responses(self, rawhtml, last_number=0):
+        document = parsed_document(rawhtml).lxml
+        resheads = document.xpath('//dt[%s]' % xpath_class('reshead'))
+        resbodies = document.xpath('//dd[%s]' % xpath_class('resbody'))
+        responses = []
+
+        for index, reshead in enumerate(resheads):
+            number = reshead.xpath('.//a[%s]/@name' % xpath_class('resnumhead'))[0]
+            if int(number) <= last_number:
+                continue
+            collapse_spaces(reshead)
+            name = reshead.xpath('.//span[%s]' % xpath_class('name'))[0].text_content().strip()
+            head_text = reshead.text_content().strip()
+            body = self.inner_html(collapse_spaces(resbodies[index])).strip()
+            responses.append((unicode(number), name, head_text, body))
+
+        return responses
+
+    def extract_community_name(self, rawhtml, is_channel):
+        document = parsed_document(rawhtml).lxml
+
+        if is_channel:
+            return document.xpath('//h1[%s]' % xpath_class('channel_name'))[0].text_content()
+        else:
+            return document.xpath('//h1[@id="community_name"]')[0].text_content()
+
+    def extract_reserved_lives(self, rawhtml, is_channel):
+        document = parsed_document(rawhtml).lxml
+        reserved_lives = []
+
+        if is_channel:
+            sections = document.xpath('//section[%s]' % xpath_class('future'))
+            if sections:
+                lives = sections[0].xpath('.//div[%s]' % xpath_class('item_right'))
+                for live in lives:
+                    collapse_spaces(live)
+                    title = live.xpath('.//h6[%s]' % xpath_class('title'))[0]
+                    link = title.xpath('.//a/@href')[0]
+                    date = live.xpath('.//p[%s]' % xpath_class('date'))[0].text_content()
+                    reserved_lives.append((title.text_content(), link, date))
+        else:
+            lives = document.xpath('//div[%s]' % xpath_class('item'))
+            for live in lives:
+                collapse_spaces(live)
+                dates = live.xpath('.//p[%s]' % xpath_class('date'))
+                titles = live.xpath('.//p[%s]' % xpath_class('title'))
+                if titles:
+                    anchor = titles[0].xpath('.//a')[0]
+                    reserved_lives.append(
+                        (anchor.text_content(), anchor.get('href'), dates[0].text_content()))
+
+        return reserved_lives
+
+
+# public methods
+def create_parser(name):
+    if name == PARSER_LXML:
+        return LxmlParser()
+    return SoupParser()
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+
+class PollSchedule(object):
+    # magic methods
+    def __init__(self, min_interval, max_interval, backoff=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.intervals = {}
+        self.next_polls = {}
+
+    # internal methods
+    def clamp(self, interval):
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    # public methods
+    def warm(self, key, timestamps, now=None):
+        # timestamps are the epoch secs of the newest items, the interval starts from the
+        # average gap between them, or from the secs since the newest one if that is longer.
+        now = time.time() if now is None else now
+        timestamps = sorted(timestamps, reverse=True)
+        if not timestamps:
+            interval = self.max_interval
+        else:
+            interval = now - timestamps[0]
+            if 1 < len(timestamps):
+                gap = float(timestamps[0] - timestamps[-1]) / (len(timestamps) - 1)
+                interval = max(interval, gap)
+        with self.lock:
+            self.intervals[key] = self.clamp(interval)
+
+    def interval(self, key):
+        with self.lock:
+            return self.intervals.get(key, self.min_interval)
+
+    def is_due(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            return self.next_polls.get(key, 0) <= now
+
+    def update(self, key, found, now=None):
+        # polls the key more often while new items are found, and backs off exponentially
+        # while nothing is found.
+        now = time.time() if now is None else now
+        with self.lock:
+            interval = self.intervals.get(key, self.min_interval)
+            if found:
+                interval = self.clamp(interval / self.backoff)
+            else:
+                interval = self.clamp(interval * self.backoff)
+            self.intervals[key] = interval
+            self.next_polls[key] = now + interval
+            return interval
+
+    def delay(self, keys, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            next_polls = [self.next_polls.get(key, 0) for key in keys]
+        if not next_polls:
+            return self.max_interval
+        return max(min(next_polls) - now, 0)
+
+
+if __name__ == "__main__":
+    pass
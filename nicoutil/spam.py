@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+REGEXP_METACHARACTERS = set('.^$*+?{}[]\\|()')
+# ng words like these are not merged; the group references depend on their own group
+# numbers, the group names must be unique in a pattern, and the inline flags apply to the
+# whole pattern.
+REGEXP_UNMERGEABLE = r'\\\d|\(\?P[=<]|\(\?[iLmsux]'
+
+
+# internal methods
+def is_literal(word):
+    return not (set(word) & REGEXP_METACHARACTERS)
+
+
+def create_trie_regexp(words):
+    # literal words are merged into a prefix tree, so the matcher tries each character of
+    # the message once instead of once per word
+    trie = {}
+    for word in words:
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node[''] = {}
+
+    def build(node):
+        if node.keys() == ['']:
+            return u''
+        branches = [re.escape(character) + build(child)
+                    for (character, child) in sorted(node.items()) if character != '']
+        regexp = branches[0] if len(branches) == 1 else u'(?:%s)' % u'|'.join(branches)
+        if '' in node:
+            regexp = u'(?:%s)?' % regexp
+        return regexp
+
+    return build(trie)
+
+
+def create_ng_word_regexps(ng_words):
+    literals = [word for word in ng_words if is_literal(word)]
+    regexps = [word for word in ng_words if not is_literal(word)]
+
+    merged = []
+    separated = []
+    if literals:
+        merged.append(create_trie_regexp(literals))
+    for regexp in regexps:
+        if re.search(REGEXP_UNMERGEABLE, regexp):
+            separated.append(re.compile(regexp))
+        else:
+            merged.append(u'(?:%s)' % regexp)
+
+    compiled = []
+    if merged:
+        compiled.append(re.compile(u'|'.join(merged)))
+    return compiled + separated
+
+
+# public methods
+class SpamFilter(object):
+    # magic methods
+    def __init__(self, ng_words, ng_hash, id_regexps, url_regexp, max_links):
+        self.ng_word_regexps = create_ng_word_regexps(ng_words)
+        self.ng_hash = set(ng_hash)
+        self.max_links = max_links
+
+        # ids like 'sm12345' are counted in the urls too, as they are when counted one by one
+        ids = [u'(?P<id%d>%s)' % (index, regexp) for (index, regexp) in enumerate(id_regexps)]
+        self.id_regexp = re.compile(u'|'.join(ids))
+        self.link_regexp = re.compile(u'|'.join([u'(?P<url>%s)' % url_regexp] + ids))
+
+    # public methods
+    def contains_ng_words(self, message):
+        for regexp in self.ng_word_regexps:
+            if regexp.search(message):
+                return True
+        return False
+
+    def contains_ng_hash(self, hash_id):
+        return hash_id in self.ng_hash
+
+    def contains_too_many_link(self, message):
+        counts = {}
+        for match in self.link_regexp.finditer(message):
+            kinds = [match.lastgroup]
+            if match.lastgroup == 'url':
+                kinds.extend([inner.lastgroup for inner in self.id_regexp.finditer(match.group())])
+            for kind in kinds:
+                counts[kind] = counts.get(kind, 0) + 1
+                if self.max_links < counts[kind]:
+                    return True
+        return False
+
+    def is_spam(self, message, hash_id):
+        return (self.contains_ng_words(message) or
+                self.contains_ng_hash(hash_id) or
+                self.contains_too_many_link(message))
+
+
+if __name__ == "__main__":
+    pass
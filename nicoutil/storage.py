@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import abc
+import calendar
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+import pymongo
+
+from nicoutil.index import bootstrap_indexes
+from nicoutil.metrics import ROUND_TRIPS
+
+# collections of the crawled items, the tables in sqlite
+ITEM_COLLECTIONS = ["response", "live", "news", "video"]
+# table of a statement, counted as the collection of the round trip
+SQL_TABLE_REGEXP = r'(?:FROM|INTO|UPDATE|TABLE|ON)\s+(\w+)'
+
+
+class Storage(object):
+    # persistence of the crawled items, the page validators and the community states.
+    # items are the dicts of a collection in ITEM_COLLECTIONS, identified by the community
+    # and the key field of the collection, like the number of a response.
+    __metaclass__ = abc.ABCMeta
+
+    # public methods
+    @abc.abstractmethod
+    def bootstrap(self):
+        # creates the indexes/tables at startup
+        pass
+
+    @abc.abstractmethod
+    def find_keys(self, collection, community, key, keys):
+        # returns the set of the keys stored already
+        pass
+
+    @abc.abstractmethod
+    def insert_items(self, collection, items):
+        pass
+
+    @abc.abstractmethod
+    def upsert_item(self, collection, key, item):
+        pass
+
+    @abc.abstractmethod
+    def update_status(self, collection, community, key, value, status, status_id):
+        pass
+
+    @abc.abstractmethod
+    def find_items(self, collection, communities, status, fields, sort=None, batch_size=0):
+        # returns the iterable of the items with the status, in the order of the sort field
+        # or of the insertion.
+        pass
+
+    @abc.abstractmethod
+    def find_status_ids(self, collection, community, key, keys):
+        # returns {key: status_id} of the stored items
+        pass
+
+    @abc.abstractmethod
+    def find_archived(self, collection, community, keys):
+        # returns [{"key": key, "status_id": status_id}, ...] of the archived items
+        pass
+
+    @abc.abstractmethod
+    def find_timestamps(self, collection, community, limit):
+        # returns the epoch secs when the newest items are stored
+        pass
+
+    @abc.abstractmethod
+    def find_recent_keys(self, collection, community, key, limit):
+        # returns the keys of the newest items
+        pass
+
+    @abc.abstractmethod
+    def load_pages(self):
+        pass
+
+    @abc.abstractmethod
+    def save_page(self, url, page):
+        pass
+
+    @abc.abstractmethod
+    def find_community(self, community):
+        pass
+
+    @abc.abstractmethod
+    def update_community(self, community, fields):
+        pass
+
+    def close(self):
+        pass
+
+
+class MongoStorage(Storage):
+    # magic methods
+    def __init__(self, database, indexes=None, obsolete_indexes=(), keys=None):
+        # keys: {collection: key field}, to check the items stored by a failed batch
+        self.database = database
+        self.indexes = indexes or {}
+        self.obsolete_indexes = obsolete_indexes
+        self.keys = keys or {}
+
+    # public methods
+    def bootstrap(self):
+        for (collection, indexes) in sorted(self.indexes.items()):
+            try:
+                bootstrap_indexes(self.database[collection], indexes, self.obsolete_indexes)
+            except Exception, error:
+                logging.error("*** caught error when creating indexes of %s, error: %s",
+                              collection, error)
+
+    def find_keys(self, collection, community, key, keys):
+        if not keys:
+            return set()
+        cursor = self.database[collection].find(
+            {"community": community, key: {"$in": keys}}, fields=[key])
+        return set([document.get(key) for document in cursor])
+
+    def insert_items(self, collection, items):
+        # acknowledged, the callers advance the last response numbers and the seen keys
+        # after it. the duplicates are the items stored by another worker meanwhile.
+        try:
+            self.database[collection].insert(items, safe=True, continue_on_error=True)
+        except pymongo.errors.DuplicateKeyError:
+            # only the last error is reported, so check that all the items are stored
+            key = self.keys.get(collection)
+            if key is None:
+                raise
+            for community in set([item["community"] for item in items]):
+                keys = [item[key] for item in items if item["community"] == community]
+                if set(keys) - self.find_keys(collection, community, key, keys):
+                    raise
+
+    def upsert_item(self, collection, key, item):
+        self.database[collection].update(
+            {"community": item["community"], key: item[key]}, item, True)
+
+    def update_status(self, collection, community, key, value, status, status_id):
+        self.database[collection].update(
+            {"community": community, key: value},
+            {"$set": {"status": status, "status_id": status_id}})
+
+    def find_items(self, collection, communities, status, fields, sort=None, batch_size=0):
+        query = {"status": status}
+        if len(communities) == 1:
+            query["community"] = communities[0]
+        else:
+            query["community"] = {"$in": communities}
+        cursor = self.database[collection].find(
+            query, fields=fields, sort=[(sort, 1)] if sort else None)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    def find_status_ids(self, collection, community, key, keys):
+        return dict([(document[key], document.get("status_id", 0))
+                     for document in self.database[collection].find(
+                         {"community": community, key: {"$in": keys}},
+                         fields=[key, "status_id"])])
+
+    def find_archived(self, collection, community, keys):
+        return self.database.archived.find(
+            {"collection": collection, "community": community, "key": {"$in": keys}},
+            fields=["key", "status_id"])
+
+    def find_timestamps(self, collection, community, limit):
+        # the ids have the secs when the documents are inserted
+        items = self.database[collection].find(
+            {"community": community}, fields=["_id"]).sort(
+            "_id", pymongo.DESCENDING).limit(limit)
+        return [calendar.timegm(item["_id"].generation_time.utctimetuple()) for item in items]
+
+    def find_recent_keys(self, collection, community, key, limit):
+        items = self.database[collection].find(
+            {"community": community}, fields=[key]).sort(
+            "_id", pymongo.DESCENDING).limit(limit)
+        return [item.get(key) for item in items]
+
+    def load_pages(self):
+        return self.database.page.find()
+
+    def save_page(self, url, page):
+        self.database.page.update({"url": url}, {"$set": page}, True)
+
+    def find_community(self, community):
+        return self.database.community.find_one({"community": community})
+
+    def update_community(self, community, fields):
+        self.database.community.update({"community": community}, {"$set": fields}, True)
+
+
+class SQLiteStorage(Storage):
+    # embedded storage for a single process. the fields other than the community, the key,
+    # the status and the status id are kept in json. one connection is shared by the
+    # threads, and the statements are serialized by the lock.
+
+    # magic methods
+    def __init__(self, path, keys, indexed_status, metrics=None):
+        # keys: {collection: key field}, and the items are indexed by the status only while
+        # they have indexed_status, like the partial indexes in mongo. the statements are
+        # counted in metrics like the round trips of InstrumentedDatabase.
+        self.path = path
+        self.keys = keys
+        self.indexed_status = indexed_status
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # wal lets the readers run with the writer, and the commits skip the fsync of the
+        # database file until the checkpoints.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    # internal methods
+    def count_statement(self, statement):
+        if self.metrics is None:
+            return
+        table = re.search(SQL_TABLE_REGEXP, statement)
+        labels = self.metrics.context()
+        labels.update({"collection": table.group(1) if table else "",
+                       "operation": statement.split(None, 1)[0].lower()})
+        self.metrics.increment(ROUND_TRIPS, **labels)
+
+    def execute(self, statement, parameters=()):
+        self.count_statement(statement)
+        with self.lock:
+            with self.connection:
+                return self.connection.execute(statement, parameters).fetchall()
+
+    def executemany(self, statement, parameters):
+        # one transaction for the batch
+        self.count_statement(statement)
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(statement, parameters)
+
+    def placeholders(self, values):
+        return ",".join(["?"] * len(values))
+
+    def split_item(self, collection, item):
+        document = dict([(field, value) for (field, value) in item.items()
+                         if field not in ["_id", "community", "status", "status_id"]])
+        return (item["community"], item[self.keys[collection]], item.get("status"),
+                item.get("status_id", 0), time.time(), json.dumps(document))
+
+    # public methods
+    def bootstrap(self):
+        statements = []
+        for collection in ITEM_COLLECTIONS:
+            statements.extend([
+                "CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, community TEXT, "
+                "key, status TEXT, status_id, created REAL, document TEXT)" % collection,
+                "CREATE UNIQUE INDEX IF NOT EXISTS %s_community_key ON %s (community, key)" %
+                (collection, collection),
+                # only the unprocessed items are queried by the status
+                "CREATE INDEX IF NOT EXISTS %s_community_status ON %s (community, status, key) "
+                "WHERE status = '%s'" % (collection, collection, self.indexed_status)])
+        statements.extend([
+            "CREATE TABLE IF NOT EXISTS page (url TEXT PRIMARY KEY, etag TEXT, "
+            "last_modified TEXT, digest TEXT)",
+            "CREATE TABLE IF NOT EXISTS community (community TEXT PRIMARY KEY, document TEXT)"])
+        with self.lock:
+            with self.connection:
+                for statement in statements:
+                    self.count_statement(statement)
+                    self.connection.execute(statement)
+
+    def find_keys(self, collection, community, key, keys):
+        if not keys:
+            return set()
+        rows = self.execute("SELECT key FROM %s WHERE community = ? AND key IN (%s)" %
+                            (collection, self.placeholders(keys)), [community] + list(keys))
+        return set([row["key"] for row in rows])
+
+    def insert_items(self, collection, items):
+        self.executemany(
+            "INSERT OR IGNORE INTO %s (community, key, status, status_id, created, document) "
+            "VALUES (?, ?, ?, ?, ?, ?)" % collection,
+            [self.split_item(collection, item) for item in items])
+
+    def upsert_item(self, collection, key, item):
+        self.executemany(
+            "INSERT OR REPLACE INTO %s (community, key, status, status_id, created, document) "
+            "VALUES (?, ?, ?, ?, ?, ?)" % collection, [self.split_item(collection, item)])
+
+    def update_status(self, collection, community, key, value, status, status_id):
+        self.execute("UPDATE %s SET status = ?, status_id = ? WHERE community = ? AND key = ?" %
+                     collection, (status, status_id, community, value))
+
+    def find_items(self, collection, communities, status, fields, sort=None, batch_size=0):
+        # read at once, the items are updated while they are iterated. the items are sorted
+        # only by the key field.
+        rows = self.execute(
+            "SELECT id, community, key, status, status_id, document FROM %s "
+            "WHERE status = ? AND community IN (%s) ORDER BY %s" %
+            (collection, self.placeholders(communities), "key, id" if sort else "id"),
+            [status] + list(communities))
+        key = self.keys[collection]
+        items = []
+        for row in rows:
+            item = json.loads(row["document"])
+            item.update({"_id": row["id"], "community": row["community"], key: row["key"],
+                         "status": row["status"], "status_id": row["status_id"]})
+            items.append(dict([(field, value) for (field, value) in item.items()
+                               if field in fields or field == "_id"]))
+        return items
+
+    def find_status_ids(self, collection, community, key, keys):
+        rows = self.execute("SELECT key, status_id FROM %s WHERE community = ? AND key IN (%s)" %
+                            (collection, self.placeholders(keys)), [community] + list(keys))
+        return dict([(row["key"], row["status_id"] or 0) for row in rows])
+
+    def find_archived(self, collection, community, keys):
+        # items are not archived in sqlite
+        return []
+
+    def find_timestamps(self, collection, community, limit):
+        rows = self.execute("SELECT created FROM %s WHERE community = ? ORDER BY id DESC "
+                            "LIMIT ?" % collection, (community, limit))
+        return [int(row["created"]) for row in rows]
+
+    def find_recent_keys(self, collection, community, key, limit):
+        rows = self.execute("SELECT key FROM %s WHERE community = ? ORDER BY id DESC LIMIT ?" %
+                            collection, (community, limit))
+        return [row["key"] for row in rows]
+
+    def load_pages(self):
+        return [dict(zip(row.keys(), row)) for row in self.execute("SELECT * FROM page")]
+
+    def save_page(self, url, page):
+        self.execute("INSERT OR REPLACE INTO page (url, etag, last_modified, digest) "
+                     "VALUES (?, ?, ?, ?)",
+                     (url, page.get("etag"), page.get("last_modified"), page.get("digest")))
+
+    def find_community(self, community):
+        rows = self.execute("SELECT document FROM community WHERE community = ?", (community,))
+        if not rows:
+            return None
+        return json.loads(rows[0]["document"])
+
+    def update_community(self, community, fields):
+        select = "SELECT document FROM community WHERE community = ?"
+        replace = "INSERT OR REPLACE INTO community (community, document) VALUES (?, ?)"
+        self.count_statement(select)
+        self.count_statement(replace)
+        with self.lock:
+            with self.connection:
+                rows = self.connection.execute(select, (community,)).fetchall()
+                document = json.loads(rows[0]["document"]) if rows else {"community": community}
+                document.update(fields)
+                self.connection.execute(replace, (community, json.dumps(document)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    pass
@@ -44,19 +44,47 @@ CHUNK_TYPE_HTTP = 3
 CHUNK_TYPE_MAIL = 4
 CHUNK_TYPE_TWITTER = 5
 
+# precompiled patterns.
+#   - '>>sm123\nsm123' like links are rewritten to urls in one pass
+#   - chunks are classified by the name of the matched group
+REWRITE_LINKS = [
+    ('video', REGEXP_VIDEO, BASE_URL_VIDEO),
+    ('live', REGEXP_LIVE, BASE_URL_LIVE),
+    ('seiga', REGEXP_SEIGA, BASE_URL_SEIGA),
+    ('community', REGEXP_COMMUNITY, BASE_URL_COMMUNITY),
+    ('manga', REGEXP_MANGA, BASE_URL_MANGA),
+    ('mylist', REGEXP_MYLIST, BASE_URL_MYLIST)]
+COMPILED_REWRITE_LINKS = re.compile(r'>>(?:%s)' % '|'.join(
+    [r'(?P<%s>%s)\n%s' % (name, regexp, regexp) for (name, regexp, base_url) in REWRITE_LINKS]))
+REWRITE_BASE_URLS = dict([(name, base_url) for (name, regexp, base_url) in REWRITE_LINKS])
+COMPILED_TRAILING_NEWLINES = re.compile(r'\n+$')
+
+COMPILED_CHUNKS = re.compile(u'(?P<http>%s)|(?P<google>%s)|(?P<mail>%s)|(?P<twitter>%s)' % (
+    REGEXP_HTTP, REGEXP_GOOGLE, REGEXP_MAIL, REGEXP_TWITTER))
+# every chunk pattern needs one of these, and none of them spans lines
+CHUNK_TRIGGERS = [u'@', u'http', u'gl/']
+CHUNK_TYPES = {
+    'http': CHUNK_TYPE_HTTP,
+    'google': CHUNK_TYPE_HTTP,
+    'mail': CHUNK_TYPE_MAIL,
+    'twitter': CHUNK_TYPE_TWITTER}
+
+COMPILED_TWITTER_REPLACE_FROM = re.compile(REGEXP_TWITTER_REPLACE_FROM)
+COMPILED_VIDEO_URL = re.compile(re.escape(BASE_URL_VIDEO) + r'([sn]m\d{3,})')
+COMPILED_LIVE_URL = re.compile(re.escape(BASE_URL_LIVE) + r'(lv\d{3,})')
+
 
 # internal methods
 def create_finalized_statuses(status_bodies, header, continued_mark, continue_mark):
     finalized_statuses = []
     status_bodies_count = len(status_bodies)
 
-    header = re.sub(REGEXP_TWITTER_REPLACE_FROM, REGEXP_TWITTER_REPLACE_TO, header)
+    header = COMPILED_TWITTER_REPLACE_FROM.sub(REGEXP_TWITTER_REPLACE_TO, header)
 
     index = 0
     for status_body in status_bodies:
         if ENABLE_MASKING_TWITTER:
-            status_body = re.sub(
-                REGEXP_TWITTER_REPLACE_FROM, REGEXP_TWITTER_REPLACE_TO, status_body)
+            status_body = COMPILED_TWITTER_REPLACE_FROM.sub(REGEXP_TWITTER_REPLACE_TO, status_body)
         if status_bodies_count == 1:
             status = header + status_body
         else:
@@ -72,69 +100,109 @@ def create_finalized_statuses(status_bodies, header, continued_mark, continue_ma
     return finalized_statuses
 
 
+def rewrite_link(match):
+    name = match.lastgroup
+    return REWRITE_BASE_URLS[name] + match.group(name)
+
+
 def replace_body(body):
-    body = re.sub(r'>>(' + REGEXP_VIDEO + r')\n' + REGEXP_VIDEO,
-                  BASE_URL_VIDEO + r'\1', body)
-    body = re.sub(r'>>(' + REGEXP_LIVE + r')\n' + REGEXP_LIVE,
-                  BASE_URL_LIVE + r'\1', body)
-    body = re.sub(r'>>(' + REGEXP_SEIGA + r')\n' + REGEXP_SEIGA,
-                  BASE_URL_SEIGA + r'\1', body)
-    body = re.sub(r'>>(' + REGEXP_COMMUNITY + r')\n' + REGEXP_COMMUNITY,
-                  BASE_URL_COMMUNITY + r'\1', body)
-    body = re.sub(r'>>(' + REGEXP_MANGA + r')\n' + REGEXP_MANGA,
-                  BASE_URL_MANGA + r'\1', body)
-    body = re.sub(r'>>(' + REGEXP_MYLIST + r')\n' + REGEXP_MYLIST,
-                  BASE_URL_MYLIST + r'\1', body)
-
-    body = re.sub(r'\n+$', '', body)
+    body = COMPILED_REWRITE_LINKS.sub(rewrite_link, body)
+    body = COMPILED_TRAILING_NEWLINES.sub('', body)
 
     return body
 
 
-def get_video_status(opener, video_id):
+def has_chunk_trigger(line):
+    for trigger in CHUNK_TRIGGERS:
+        if trigger in line:
+            return True
+    return False
+
+
+def split_chunks(body):
+    # yields (chunk_type, chunk) in one scan of the body. lines without any trigger are
+    # passed through as text without scanning.
+    lines = body.split(u'\n')
+    texts = []
+    for index, line in enumerate(lines):
+        if index < len(lines) - 1:
+            line += u'\n'
+        if not has_chunk_trigger(line):
+            texts.append(line)
+            continue
+
+        position = 0
+        for match in COMPILED_CHUNKS.finditer(line):
+            texts.append(line[position:match.start()])
+            text = u"".join(texts)
+            if text:
+                yield CHUNK_TYPE_TEXT, text
+            texts = []
+            yield CHUNK_TYPES[match.lastgroup], match.group()
+            position = match.end()
+        texts.append(line[position:])
+
+    text = u"".join(texts)
+    if text:
+        yield CHUNK_TYPE_TEXT, text
+
+
+# fetch_*_status returns (status, failed)
+def fetch_video_status(opener, video_id):
     url = API_VIDEO_INFO + video_id
     xml = ET.fromstring(opener.open(url).read())
     if xml.attrib.get('status') == 'fail':
-        return BASE_URL_VIDEO + video_id
+        return BASE_URL_VIDEO + video_id, True
     thumb = xml.find('thumb')
     title = thumb.find('title').text
     name = thumb.find('user_nickname').text
 
-    return ('[%s:%s]\n' + BASE_URL_VIDEO + '%s') % (title, name, video_id)
+    return ('[%s:%s]\n' + BASE_URL_VIDEO + '%s') % (title, name, video_id), False
 
 
-def get_live_status(opener, live_id):
+def fetch_live_status(opener, live_id):
     url = API_LIVE_INFO + live_id
     xml = ET.fromstring(opener.open(url).read())
     if xml.attrib.get('status') == 'fail':
-        return BASE_URL_LIVE + live_id
+        return BASE_URL_LIVE + live_id, True
     stream = xml.find('stream')
     title = stream.find('title').text
     name = stream.find('owner_name').text
 
     if name is None:
-        return ('[%s]\n' + BASE_URL_LIVE + '%s') % (title, live_id)
-    return ('[%s:%s]\n' + BASE_URL_LIVE + '%s') % (title, name, live_id)
+        return ('[%s]\n' + BASE_URL_LIVE + '%s') % (title, live_id), False
+    return ('[%s:%s]\n' + BASE_URL_LIVE + '%s') % (title, name, live_id), False
 
 
-def parse_video_info(opener, body):
-    match = re.findall(BASE_URL_VIDEO + '([sn]m\d{3,})', body)
-    for video_id in list(set(match)):
-        text = get_video_status(opener, video_id)
-        body = re.sub(BASE_URL_VIDEO + video_id, text, body)
-    return body
+def get_video_status(opener, video_id):
+    return fetch_video_status(opener, video_id)[0]
 
 
-def parse_live_info(opener, body):
-    match = re.findall(BASE_URL_LIVE + '(lv\d{3,})', body)
-    for live_id in list(set(match)):
-        text = get_live_status(opener, live_id)
-        body = re.sub(BASE_URL_LIVE + live_id, text, body)
-    return body
+def get_live_status(opener, live_id):
+    return fetch_live_status(opener, live_id)[0]
+
+
+def lookup_statuses(opener, ids, fetch, metadata_cache=None):
+    if metadata_cache is None:
+        return dict([(id, fetch(opener, id)[0]) for id in ids])
+    return metadata_cache.lookup(ids, lambda id: fetch(opener, id))
+
+
+def parse_video_info(opener, body, metadata_cache=None):
+    match = COMPILED_VIDEO_URL.findall(body)
+    statuses = lookup_statuses(opener, list(set(match)), fetch_video_status, metadata_cache)
+    return COMPILED_VIDEO_URL.sub(lambda matched: statuses[matched.group(1)], body)
+
+
+def parse_live_info(opener, body, metadata_cache=None):
+    match = COMPILED_LIVE_URL.findall(body)
+    statuses = lookup_statuses(opener, list(set(match)), fetch_live_status, metadata_cache)
+    return COMPILED_LIVE_URL.sub(lambda matched: statuses[matched.group(1)], body)
 
 
 # public methods
-def create_twitter_statuses(header, continued_mark, body, continue_mark, opener=None):
+def create_twitter_statuses(header, continued_mark, body, continue_mark, opener=None,
+                            metadata_cache=None):
     available_length = TWITTER_STATUS_MAX_LENGTH - len(header + continued_mark + continue_mark)
     # print available_length
 
@@ -142,33 +210,21 @@ def create_twitter_statuses(header, continued_mark, body, continue_mark, opener=
     body = replace_body(body)
     # print 'after replace: [' + body + ']'
     if opener:
-        body = parse_video_info(opener, body)
-        body = parse_live_info(opener, body)
+        body = parse_video_info(opener, body, metadata_cache)
+        body = parse_live_info(opener, body, metadata_cache)
 
     statuses_with_body = []
     status_buffer = u""
     chunk_type = CHUNK_TYPE_UNKNOWN
     remaining_length = available_length
 
-    regexp = u'(%s|%s|%s|%s)' % (REGEXP_HTTP, REGEXP_GOOGLE, REGEXP_MAIL, REGEXP_TWITTER)
-    chunks = re.split(regexp, body)
-
-    for chunk in chunks:
+    for (chunk_type, chunk) in split_chunks(body):
         # print u'chunk: [' + chunk + u']'
         # print u'remaining_length, pre-processed: %d' % remaining_length
 
-        chunk_length = 0
-        if re.match(REGEXP_HTTP, chunk) or re.match(REGEXP_GOOGLE, chunk):
-            chunk_type = CHUNK_TYPE_HTTP
+        chunk_length = len(chunk)
+        if chunk_type == CHUNK_TYPE_HTTP:
             chunk_length = TCO_URL_LENGTH
-        elif re.match(REGEXP_MAIL, chunk):
-            chunk_type = CHUNK_TYPE_MAIL
-            chunk_length = len(chunk)
-        elif re.match(REGEXP_TWITTER, chunk):
-            chunk_type = CHUNK_TYPE_TWITTER
-            chunk_length = len(chunk)
-        else:
-            chunk_type = CHUNK_TYPE_TEXT
 
         if chunk_type in [CHUNK_TYPE_HTTP, CHUNK_TYPE_MAIL, CHUNK_TYPE_TWITTER]:
             if chunk_length <= remaining_length:
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import gzip
 import os
 from datetime import datetime as dt
 import re
+import time
 
 import nicobbs
 
@@ -42,7 +44,11 @@ def pytest_funcarg__bbs(request):
         bbs.access_secret[community] = TEST_ACCESS_SECRET
 
     bbs.database_name = TEST_DATABASE_NAME
+    # every test starts with an empty database, the unique indexes reject the old items
+    bbs.connection.drop_database(bbs.database_name)
     bbs.database = bbs.connection[bbs.database_name]
+    bbs.storage = nicobbs.nicoutil.MongoStorage(
+        bbs.database, nicobbs.INDEXES, nicobbs.OBSOLETE_INDEXES, nicobbs.ITEM_KEYS)
 
     return bbs
 
@@ -52,6 +58,17 @@ def test_is_channel(bbs):
     assert bbs.is_channel('abcdef') is True
 
 
+def test_oekaki_path(bbs):
+    # response numbers are shared by the communities
+    assert bbs.get_oekaki_path("co1", "10") != bbs.get_oekaki_path("co2", "10")
+
+
+def test_worker_path(bbs):
+    assert bbs.get_worker_path("/path/nicobbs.cookie") == "/path/nicobbs.cookie"
+    bbs.worker = "2"
+    assert bbs.get_worker_path("/path/nicobbs.cookie") == "/path/nicobbs-2.cookie"
+
+
 def read_test_page(path):
     f = open(path)
     content = f.read()
@@ -93,6 +110,76 @@ def test_response(bbs):
     # bbs.tweet_response(community, limit=2)
 
 
+def test_response_incremental(bbs):
+    community = 'co1234'
+    html = read_test_page(TEST_COMMUNITY_BBS_PAGE)
+
+    bbs.last_response_numbers[community] = 69355
+    responses = bbs.parse_response(html, community)
+    assert [response['number'] for response in responses] == [
+        '69356', '69357', '69358', '69359', '69360']
+
+    # no gap, no page read
+    assert bbs.fill_response_gap(None, community, responses) == responses
+
+    # the gap page is timed as read and parse
+    bbs.read_response_gap_page = lambda opener, community, number: html
+    assert bbs.fill_response_gap(None, community, responses[2:]) == responses
+    stages = dict([(sample["labels"]["stage"], sample["count"]) for sample in
+                   bbs.metrics.snapshot()["metrics"][nicobbs.STAGE_SECONDS]["samples"]])
+    assert stages == {"read": 1, "parse": 1}
+
+
+def test_reply_status_ids(bbs):
+    community = 'co1234'
+    html = read_test_page(TEST_COMMUNITY_BBS_PAGE)
+    responses = bbs.parse_response(html, community)
+    bbs.database.response.remove({"community": community})
+    bbs.register_responses(responses, community)
+
+    first, second = responses[0]["number"], responses[1]["number"]
+    bbs.database.response.update({"community": community, "number": second},
+                                 {"$set": {"status_id": "2"}})
+    bbs.load_reply_status_ids(community, [first, second, "99999999"])
+    assert bbs.get_reply_status_ids(community).get(first) == 0
+    assert bbs.get_reply_status_ids(community).get(second) == "2"
+    assert bbs.get_reply_status_ids(community).get("99999999") == 0
+
+    # completed statuses are kept without reading them again
+    bbs.update_response_status(responses[0], nicobbs.STATUS_COMPLETED, "1")
+    bbs.database.response.remove({"community": community})
+    assert bbs.get_reply_status_id(community, first) == "1"
+
+
+def test_parser_compatibility(bbs):
+    soup_parser = nicobbs.nicoutil.SoupParser()
+    lxml_parser = nicobbs.nicoutil.LxmlParser()
+
+    def parse_with(parser, method, html, community):
+        bbs.parser = parser
+        bbs.last_response_numbers[community] = 0
+        return method(html, community)
+
+    html = read_test_page(TEST_COMMUNITY_BBS_PAGE)
+    assert (parse_with(soup_parser, bbs.parse_response, html, 'co1234') ==
+            parse_with(lxml_parser, bbs.parse_response, html, 'co1234'))
+
+    # entities and escaped angle brackets, in the body and around the child tags
+    body = u'a &amp; b &lt;c&gt;<br>d &gt; e<b>f &amp; g</b> h &lt;i&gt;'
+    html = re.sub(r'(<dd class="resbody">).*?(</dd>)', lambda match: (
+        match.group(1) + body.encode('utf_8') + match.group(2)), html, 1, re.DOTALL)
+    responses = parse_with(soup_parser, bbs.parse_response, html, 'co1234')
+    assert responses == parse_with(lxml_parser, bbs.parse_response, html, 'co1234')
+    assert (bbs.prefilter_message(soup_parser.extract_responses(html)[0][3]) ==
+            bbs.prefilter_message(lxml_parser.extract_responses(html)[0][3]))
+
+    for community, path in [('co1234', TEST_COMMUNITY_TOP_PAGE),
+                            ('abcdef', TEST_CHANNEL_LIVE_PAGE)]:
+        html = read_test_page(path)
+        assert (parse_with(soup_parser, bbs.parse_reserved_live, html, community) ==
+                parse_with(lxml_parser, bbs.parse_reserved_live, html, community))
+
+
 #def test_read_live(bbs):
 #    opener = bbs.create_opener()
 #
@@ -200,6 +287,233 @@ def test_video(bbs):
     # bbs.tweet_video(community, limit=2)
 
 
+def test_register_items(bbs):
+    community = 'co1234'
+    html = read_test_page(TEST_COMMUNITY_VIDEO_PAGE)
+    videos = bbs.parse_video(html, community)
+    bbs.database.video.remove({"community": community})
+
+    registered, skipped = bbs.register_videos(videos[:1], community)
+    assert len(registered) == 1 and len(skipped) == 0
+
+    registered, skipped = bbs.register_videos(videos, community)
+    assert len(registered) == len(videos) - 1
+    assert skipped[0]['link'] == videos[0]['link']
+    assert bbs.database.video.find({"community": community}).count() == len(videos)
+
+    # the items stored by another worker meanwhile are duplicates, not errors
+    bbs.bootstrap_indexes()
+    duplicate = dict([(field, value) for (field, value) in videos[0].items() if field != "_id"])
+    bbs.storage.insert_items("video", [duplicate])
+    assert bbs.database.video.find({"community": community}).count() == len(videos)
+
+    # the keys are not seen until the insert is acknowledged
+    def fail(collection, items):
+        raise nicobbs.pymongo.errors.OperationFailure("not stored")
+    bbs.storage.insert_items = fail
+    new_video = dict(duplicate, link="http://www.nicovideo.jp/watch/sm0")
+    try:
+        bbs.register_videos([new_video], community)
+    except nicobbs.pymongo.errors.OperationFailure:
+        pass
+    assert new_video["link"] not in bbs.get_seen_keys("video", community)
+
+
+def test_bootstrap_indexes(bbs):
+    bbs.database.response.drop()
+    bbs.database.live.drop()
+    bbs.database.response.create_index([("community", 1), ("number", 1)])
+    bbs.database.response.create_index([("community", 1), ("status", 1)])
+    # duplicates stored before the unique index
+    bbs.database.live.insert([{"community": 'co1234', "link": 'a'},
+                              {"community": 'co1234', "link": 'a'}])
+
+    bbs.bootstrap_indexes()
+    assert sorted(bbs.database.response.index_information().keys()) == [
+        '_id_', 'community_1_number_1_unique', 'community_1_status_1_number_1_partial']
+    assert sorted(bbs.database.live.index_information().keys()) == [
+        '_id_', 'community_1_link_1_unique_fallback', 'community_1_status_1_partial']
+    assert 'expires_1' in bbs.database.metadata.index_information()
+
+    # existing indexes are kept as they are
+    bbs.bootstrap_indexes()
+    assert 'community_1_link_1_unique_fallback' in bbs.database.live.index_information()
+
+
+def test_archive_items(bbs, tmpdir):
+    community = 'co1234'
+    html = read_test_page(TEST_COMMUNITY_VIDEO_PAGE)
+    videos = bbs.parse_video(html, community)
+    for database_name in ["video", "video_archive", "archived"]:
+        bbs.database[database_name].remove()
+    if "video_archive" not in bbs.database.collection_names():
+        bbs.database.create_collection("video_archive")
+    bbs.register_videos(videos, community)
+    bbs.update_video_status(videos[0], nicobbs.STATUS_COMPLETED, "1")
+    # copied by an interrupted batch already
+    bbs.database.video_archive.insert(bbs.database.video.find_one({"link": videos[0]["link"]}))
+
+    bbs.target_communities = [community]
+    # the items just inserted are archived with the cut-off in the future
+    bbs.archive_after = -1
+    bbs.archiver = nicobbs.nicoutil.Archiver(bbs.database.archived)
+    bbs.archive_items()
+    assert bbs.database.video.find().count() == len(videos) - 1
+    assert bbs.database.video_archive.find().count() == 1
+    assert bbs.database.video_archive.find_one()["link"] == videos[0]["link"]
+    assert bbs.database.archived.find_one()["status_id"] == "1"
+
+    # archived items are not registered again
+    registered, skipped = bbs.register_videos(videos, community)
+    assert len(registered) == 0 and len(skipped) == len(videos)
+
+    bbs.update_video_status(videos[1], nicobbs.STATUS_SPAM)
+    bbs.archiver = nicobbs.nicoutil.Archiver(bbs.database.archived, str(tmpdir))
+    bbs.archive_items()
+    lines = gzip.open(str(tmpdir.join("video_archive.json.gz"))).readlines()
+    assert len(lines) == 1 and videos[1]["link"] in lines[0]
+
+
+def test_unprocessed_items(bbs):
+    html = read_test_page(TEST_COMMUNITY_VIDEO_PAGE)
+    bbs.database.video.remove()
+    for community in bbs.target_communities:
+        bbs.register_videos(bbs.parse_video(html, community), community)
+    videos = list(bbs.get_unprocessed_items("video", 'co1234'))
+    assert 0 < len(videos)
+    assert sorted(videos[0].keys()) == sorted(nicobbs.ITEM_FIELDS["video"] + ["_id"])
+
+    # prefetched items are handed out once for each community
+    bbs.prefetch_unprocessed_items(bbs.target_communities)
+    assert bbs.get_unprocessed_items("video", 'co1234') == videos
+    assert bbs.get_unprocessed_items("video", 'co1234') == []
+    assert len(bbs.get_unprocessed_items("video", 'abcdef')) == len(videos)
+
+
+def test_item_timestamps(bbs):
+    community = 'co1234'
+    bbs.database.video.remove({"community": community})
+    assert bbs.get_item_timestamps(community, nicobbs.POLL_VIDEO) == []
+
+    html = read_test_page(TEST_COMMUNITY_VIDEO_PAGE)
+    bbs.register_videos(bbs.parse_video(html, community), community)
+    timestamps = bbs.get_item_timestamps(community, nicobbs.POLL_VIDEO)
+    assert 0 < len(timestamps) <= nicobbs.POLL_WARM_ITEMS
+    assert abs(timestamps[0] - time.time()) < 60
+
+
+def test_seen_keys(bbs):
+    community = 'co1234'
+    html = read_test_page(TEST_COMMUNITY_VIDEO_PAGE)
+    videos = bbs.parse_video(html, community)
+    bbs.database.video.remove()
+    bbs.register_videos(videos, community)
+
+    # the keys seen already are not queried again
+    bbs.database.video.remove()
+    registered, skipped = bbs.register_videos(videos, community)
+    assert len(registered) == 0 and len(skipped) == len(videos)
+    assert bbs.is_video_registered(videos[0])
+
+    bbs.seen_keys = {}
+    registered, skipped = bbs.register_videos(videos, community)
+    assert len(registered) == len(videos)
+
+    # warmed with the stored keys at startup
+    bbs.seen_keys = {}
+    bbs.target_communities = [community]
+    bbs.warm_seen_keys()
+    seen_keys = bbs.get_seen_keys("video", community)
+    assert len(seen_keys) == len(videos) and videos[0]["link"] in seen_keys
+
+
+def test_sqlite_storage(bbs, tmpdir):
+    bbs.storage = nicobbs.nicoutil.SQLiteStorage(
+        str(tmpdir.join("nicobbs.sqlite")), nicobbs.ITEM_KEYS, nicobbs.STATUS_UNPROCESSED,
+        bbs.metrics)
+    bbs.bootstrap_indexes()
+    community = 'co1234'
+
+    videos = bbs.parse_video(read_test_page(TEST_COMMUNITY_VIDEO_PAGE), community)
+    with bbs.stage_timer(community, "video", "store"):
+        registered, skipped = bbs.register_videos(videos[:1], community)
+    assert len(registered) == 1 and len(skipped) == 0
+    # the statements are counted as the round trips of the stage
+    round_trips = dict([(sample["labels"]["operation"], sample["value"]) for sample in
+                        bbs.metrics.snapshot()["metrics"]["db_round_trips_total"]["samples"]
+                        if sample["labels"].get("stage") == "store"])
+    assert round_trips == {"select": 1, "insert": 1}
+    registered, skipped = bbs.register_videos(videos, community)
+    assert len(registered) == len(videos) - 1 and len(skipped) == 1
+    assert bbs.is_video_registered(videos[0])
+
+    bbs.update_video_status(videos[0], nicobbs.STATUS_COMPLETED, 1)
+    unprocessed = bbs.get_unprocessed_items("video", community)
+    assert [video["link"] for video in unprocessed] == [video["link"] for video in videos[1:]]
+    assert sorted(unprocessed[0].keys()) == sorted(nicobbs.ITEM_FIELDS["video"] + ["_id"])
+
+    # responses are read in the order of the numbers, and their status ids are kept
+    bbs.last_response_numbers[community] = 0
+    responses = bbs.parse_response(read_test_page(TEST_COMMUNITY_BBS_PAGE), community)
+    bbs.register_responses(list(reversed(responses)), community)
+    assert ([response["number"] for response in bbs.get_unprocessed_items("response", community)]
+            == [response["number"] for response in responses])
+    bbs.update_response_status(responses[0], nicobbs.STATUS_COMPLETED, 1234567890123456789)
+    bbs.reply_status_ids = {}
+    assert bbs.get_reply_status_id(community, responses[0]["number"]) == 1234567890123456789
+
+    bbs.register_page("http://example.com/", {"etag": "a", "last_modified": None, "digest": "b"})
+    bbs.update_last_response_number(community, 10)
+    bbs.last_response_numbers = {}
+    assert bbs.get_last_response_number(community) == 10
+    assert [page["etag"] for page in bbs.storage.load_pages()] == ["a"]
+    assert abs(bbs.get_item_timestamps(community, nicobbs.POLL_VIDEO)[0] - time.time()) < 60
+
+
+def test_twitter_api(bbs):
+    api = bbs.twitter_api('co1234')
+    assert bbs.twitter_api('co1234') is api
+    assert bbs.twitter_api('abcdef') is not api
+
+
+def test_lease_manager(bbs):
+    bbs.database.lease.remove()
+    bbs.database.worker.remove()
+    keys = ['co1', 'co2', 'co3', 'co4']
+
+    worker_a = nicobbs.nicoutil.LeaseManager(bbs.database.lease, bbs.database.worker, 'a', 60)
+    assert worker_a.balance(keys) == keys
+
+    # leases held by a live worker are not taken
+    worker_b = nicobbs.nicoutil.LeaseManager(bbs.database.lease, bbs.database.worker, 'b', 60)
+    assert worker_b.balance(keys) == []
+
+    # worker a hands over the leases beyond its share at the next heartbeat
+    assert worker_a.balance(keys) == []
+    assert worker_a.held(keys) == ['co1', 'co2']
+    assert worker_b.balance(keys) == ['co3', 'co4']
+
+    # leases of the dead worker are taken over after they expire
+    expired = dt(1970, 1, 1)
+    bbs.database.worker.update({"_id": 'a'}, {"$set": {"expires": expired}})
+    bbs.database.lease.update({"owner": 'a'}, {"$set": {"expires": expired}}, multi=True)
+    assert worker_b.balance(keys) == ['co1', 'co2']
+    assert worker_b.held(keys) == keys
+
+    # leases not renewed for the ttl are dropped, they may belong to the others
+    renewed = worker_b.renewed
+    worker_b.renewed = expired
+    assert worker_b.held(keys) == []
+    worker_b.renewed = renewed
+    assert worker_b.balance(keys) == []
+    assert worker_b.held(keys) == keys
+
+    # leases released at the shutdown are taken over at once
+    bbs.lease_manager = worker_b
+    bbs.release_leases()
+    assert bbs.active_communities() == []
+    assert worker_a.balance(keys) == keys
+
 #def test_tweet(bbs):
 #    bbs.update_twitter_status(TEST_COMMUNITY_ID, u'テスト from nicobbs (%s)' % dt.now())
 #    assert True
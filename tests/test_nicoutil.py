@@ -1,7 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import BaseHTTPServer
+import json
+import logging
+import os
 import re
+import threading
+import time
+import urllib
+from StringIO import StringIO
+
+from bson.son import SON
 
 import nicoutil
 
@@ -77,6 +87,27 @@ def test_google():
     check(test_string)
 
 
+def test_replace_body():
+    body = u">>sm123\nsm123 >>lv1234\nlv1234 >>mylist/1234\nmylist/1234\n\n"
+    assert nicoutil.replace_body(body) == (
+        nicoutil.BASE_URL_VIDEO + u"sm123 " + nicoutil.BASE_URL_LIVE + u"lv1234 " +
+        nicoutil.BASE_URL_MYLIST + u"mylist/1234")
+
+
+def test_split_chunks():
+    body = u"abc\nhttp://example.com/a goo.gl/abc\nx test@example.com @test\nabc"
+    assert list(nicoutil.split_chunks(body)) == [
+        (nicoutil.CHUNK_TYPE_TEXT, u"abc\n"),
+        (nicoutil.CHUNK_TYPE_HTTP, u"http://example.com/a"),
+        (nicoutil.CHUNK_TYPE_TEXT, u" "),
+        (nicoutil.CHUNK_TYPE_HTTP, u"goo.gl/abc"),
+        (nicoutil.CHUNK_TYPE_TEXT, u"\nx "),
+        (nicoutil.CHUNK_TYPE_MAIL, u"test@example.com"),
+        (nicoutil.CHUNK_TYPE_TEXT, u" "),
+        (nicoutil.CHUNK_TYPE_TWITTER, u"@test"),
+        (nicoutil.CHUNK_TYPE_TEXT, u"\nabc")]
+
+
 def check(target):
     # need to convert body from str type to unicode type
     target = target.decode('UTF-8')
@@ -103,3 +134,419 @@ def test_replace_atmark():
 
     statuses = nicoutil.create_twitter_statuses(u"a", u"", u"＠abc", u"")
     assert statuses[0] == u"a%abc"
+
+
+def test_host_throttle():
+    throttle = nicoutil.HostThrottle(0.2)
+
+    start = time.time()
+    throttle.wait("http://com.nicovideo.jp/bbs/co1234")
+    throttle.wait("http://dic.nicovideo.jp/b/c/co1234/")
+    assert time.time() - start < 0.1
+
+    throttle.wait("http://com.nicovideo.jp/community/co1234")
+    assert 0.15 < time.time() - start
+
+
+def test_token_bucket():
+    bucket = nicoutil.TokenBucket(2, 10, 0.05)
+
+    start = time.time()
+    bucket.acquire()
+    bucket.acquire()
+    assert 0.04 < time.time() - start < 0.1
+
+    # the bucket is empty, and refilled by 10 tokens per sec
+    assert 0.01 < bucket.delay() <= 0.1
+    bucket.acquire()
+    assert 0.1 < time.time() - start
+
+    bucket.suspend(60)
+    assert 59 < bucket.delay()
+
+
+def test_poll_schedule():
+    schedule = nicoutil.PollSchedule(10, 100, 2.0)
+    now = 1000000
+
+    # warmed by the gaps between the newest items, or by the secs since the newest one
+    schedule.warm('busy', [now - 10, now - 30, now - 50], now)
+    schedule.warm('idle', [now - 60], now)
+    schedule.warm('dead', [], now)
+    assert schedule.interval('busy') == 20
+    assert schedule.interval('idle') == 60
+    assert schedule.interval('dead') == 100
+
+    assert schedule.is_due('busy', now)
+    assert schedule.update('busy', True, now) == 10
+    assert schedule.update('busy', True, now) == 10
+    assert not schedule.is_due('busy', now + 5)
+    assert schedule.delay(['busy', 'unknown'], now) == 0
+
+    assert schedule.update('idle', False, now) == 100
+    assert schedule.delay(['busy', 'idle'], now) == 10
+
+
+class CountingOpener(object):
+    def __init__(self):
+        self.urls = []
+
+    def open(self, url, data=None):
+        self.urls.append(url)
+        return urllib.addinfourl(StringIO("body of " + url), {}, url, 200)
+
+
+def test_fetch_engine():
+    opener = CountingOpener()
+    engine = nicoutil.FetchEngine(opener, 2)
+
+    urls = ["http://example.com/a", "http://example.com/b"]
+    assert engine.fetch_all(urls) == ["body of " + url for url in urls]
+    assert sorted(opener.urls) == urls
+
+    # prefetched page is consumed by the first open(), the next one reads it again
+    engine.prefetch(urls[:1])
+    assert engine.open(urls[0]).read() == "body of " + urls[0]
+    assert engine.open(urls[0]).read() == "body of " + urls[0]
+    assert len(opener.urls) == 4
+
+    engine.close()
+
+
+class StreamingResponse(object):
+    def __init__(self, chunks, event):
+        self.chunks = chunks
+        self.event = event
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        self.event.wait()
+        for chunk in self.chunks:
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class StreamingOpener(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.urls = []
+        self.responses = []
+
+    def open_stream(self, url):
+        self.urls.append(url)
+        if url.endswith("/missing"):
+            raise IOError("not found")
+        response = StreamingResponse(["chunk1", "chunk2"], self.event)
+        self.responses.append(response)
+        return response
+
+
+def test_downloader(tmpdir):
+    opener = StreamingOpener()
+    downloader = nicoutil.Downloader(2)
+    path = str(tmpdir.join("1.png"))
+
+    # the file appears only when the download completes
+    assert downloader.submit(opener, "http://example.com/1.png", path)
+    assert not downloader.submit(opener, "http://example.com/1.png", path)
+    assert not os.path.exists(path)
+    opener.event.set()
+    assert downloader.wait(path)
+    assert open(path).read() == "chunk1chunk2"
+    assert opener.responses[0].closed
+
+    # the files already downloaded are skipped
+    assert not downloader.submit(opener, "http://example.com/1.png", path)
+    assert len(opener.urls) == 1
+
+    # failed downloads leave no file behind
+    path = str(tmpdir.join("2.png"))
+    assert downloader.submit(opener, "http://example.com/missing", path)
+    assert not downloader.wait(path)
+    assert os.listdir(str(tmpdir)) == ["1.png"]
+
+    downloader.close()
+
+
+class StubNicoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    logins = 0
+
+    def do_POST(self):
+        StubNicoHandler.logins += 1
+        self.send_response(200)
+        self.send_header("Set-Cookie", "user_session=session_%d; Path=/" % StubNicoHandler.logins)
+        self.end_headers()
+
+    def do_GET(self):
+        logged_in = "user_session=session_" in self.headers.get("Cookie", "")
+        self.send_response(200)
+        self.send_header(nicoutil.AUTHFLAG_HEADER, "1" if logged_in else "0")
+        self.end_headers()
+        self.wfile.write("logged in" if logged_in else "logged out")
+
+    def log_message(self, *args):
+        pass
+
+
+def test_nico_session(tmpdir):
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StubNicoHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base_url = "http://127.0.0.1:%d" % server.server_port
+    cookie_file = str(tmpdir.join("nicobbs.cookie"))
+    throttle = nicoutil.HostThrottle(0)
+
+    # expired (no) session is detected, then login happens only once
+    session = nicoutil.NicoSession(base_url + "/login", "mail", "password", cookie_file,
+                                   throttle, 2)
+    assert not session.has_cookies()
+    assert session.open(base_url + "/bbs").read() == "logged in"
+    assert session.open(base_url + "/bbs").read() == "logged in"
+    assert StubNicoHandler.logins == 1
+
+    # the session is reused across restarts through the cookie file
+    session = nicoutil.NicoSession(base_url + "/login", "mail", "password", cookie_file,
+                                   throttle, 2)
+    assert session.has_cookies()
+    assert session.open(base_url + "/bbs").read() == "logged in"
+    assert StubNicoHandler.logins == 1
+
+    # the expired session is not reused
+    for cookie in session.session.cookies:
+        cookie.expires = 1
+    assert not session.has_cookies()
+
+    server.shutdown()
+
+
+def test_page_validators():
+    validators = nicoutil.PageValidators()
+    url = "http://com.nicovideo.jp/community/co1234"
+
+    def reader(body, code=200):
+        headers = {"etag": '"abc"', "last-modified": "Sat, 01 Mar 2014 00:00:00 GMT"}
+        return urllib.addinfourl(StringIO(body), headers, url, code)
+
+    assert validators.headers(url) == {}
+    assert not validators.is_unchanged(url, reader("a"), "a")
+
+    # validators are not used until the page is committed
+    assert validators.headers(url) == {}
+    validators.commit(url)
+    assert validators.headers(url) == {
+        "If-None-Match": '"abc"', "If-Modified-Since": "Sat, 01 Mar 2014 00:00:00 GMT"}
+
+    assert validators.is_unchanged(url, reader("", 304), "")
+    assert validators.is_unchanged(url, reader("a"), "a")
+    assert not validators.is_unchanged(url, reader("b"), "b")
+
+
+def test_parsed_document():
+    path = os.path.dirname(os.path.abspath(__file__)) + '/community_top.html'
+    rawhtml = open(path).read()
+    document = nicoutil.ParsedDocument(rawhtml)
+
+    # trees are built lazily, once per document
+    assert document.soup is document.soup
+    assert document.lxml is document.lxml
+
+    # parse_document builds the tree of the parser up front
+    parsed = nicoutil.SoupParser().parse_document(rawhtml)
+    assert parsed.soup_tree is not None and parsed.lxml_tree is None
+    parsed = nicoutil.LxmlParser().parse_document(rawhtml)
+    assert parsed.lxml_tree is not None and parsed.soup_tree is None
+    assert nicoutil.LxmlParser().parse_document(parsed) is parsed
+
+    for parser in [nicoutil.SoupParser(), nicoutil.LxmlParser()]:
+        assert (parser.extract_community_name(document, False) ==
+                parser.extract_community_name(rawhtml, False))
+        assert (parser.extract_reserved_lives(document, False) ==
+                parser.extract_reserved_lives(rawhtml, False))
+
+
+def test_lru_cache():
+    cache = nicoutil.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    # "b" is the least recently used one
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    cache.put("d", 4, ttl=0)
+    assert cache.get("d") is None
+
+
+class VideoInfoOpener(CountingOpener):
+    def open(self, url, data=None):
+        self.urls.append(url)
+        video_id = url.split('/')[-1]
+        if video_id == 'sm9999':
+            body = '<nicovideo_thumb_response status="fail"/>'
+        else:
+            body = ('<nicovideo_thumb_response status="ok"><thumb><title>title %s</title>'
+                    '<user_nickname>name</user_nickname></thumb></nicovideo_thumb_response>' %
+                    video_id)
+        return urllib.addinfourl(StringIO(body), {}, url, 200)
+
+
+def test_metadata_cache():
+    opener = VideoInfoOpener()
+    cache = nicoutil.MetadataCache(100, 60, 0)
+    body = nicoutil.BASE_URL_VIDEO + u'sm1234 ' + nicoutil.BASE_URL_VIDEO + u'sm9999'
+
+    parsed = nicoutil.parse_video_info(opener, body, cache)
+    assert parsed == nicoutil.parse_video_info(opener, body)
+    assert u'[title sm1234:name]' in parsed
+    assert len(opener.urls) == 4
+
+    # sm1234 is cached, failed sm9999 is cached only for the negative ttl
+    nicoutil.parse_video_info(opener, body, cache)
+    assert len(opener.urls) == 5
+    assert opener.urls[-1].endswith('sm9999')
+
+
+def test_spam_filter():
+    ng_words = [u"ばか", u"ばかもの", u"spam", u"a.c", u"(x)\\1"]
+    id_regexps = ["sm\d{5,}", "co\d{5,}"]
+    url_regexp = "https?://[\w/:%#\$&\?\(\)~\.=\+\-]+"
+    spam_filter = nicoutil.SpamFilter(ng_words, [u"abc"], id_regexps, url_regexp, 2)
+
+    # same as searching the words one by one
+    for message in [u"ばかもの", u"あばか", u"ば か", u"xspamx", u"abc", u"a-c", u"xx", u"x"]:
+        assert spam_filter.contains_ng_words(message) == any(
+            [re.search(word, message) for word in ng_words])
+
+    assert spam_filter.contains_ng_hash(u"abc")
+    assert not spam_filter.contains_ng_hash(u"abcd")
+
+    # inline flags stay in their own word, and the same group names do not conflict
+    ng_words = [u"abc", u"(?i)spam", u"(?P<w>ham)", u"(?P<w>egg)"]
+    spam_filter = nicoutil.SpamFilter(ng_words, [], id_regexps, url_regexp, 2)
+    for message in [u"abc", u"ABC", u"SPAM", u"ham", u"egg", u"HAM"]:
+        assert spam_filter.contains_ng_words(message) == any(
+            [re.search(word, message) for word in ng_words])
+
+    # same as counting the links one by one, ids in the urls are counted too
+    for message in [u"sm12345 sm12345", u"sm12345 sm12345 sm12345",
+                    u"http://a/sm12345 http://b/sm12345 sm12345",
+                    u"http://a http://b co12345", u"http://a http://b http://c",
+                    u"co12345 sm12345 co12345 sm12345"]:
+        assert spam_filter.contains_too_many_link(message) == any(
+            [2 < len(re.findall(regexp, message)) for regexp in id_regexps + [url_regexp]])
+
+
+class FakeCollection(object):
+    name = "response"
+
+    def find_one(self, query):
+        return query
+
+
+class FakeCommandDatabase(object):
+    # mongo 3.0+ lists the indexes and the collections only by the commands
+    def command(self, command, value=1, **kwargs):
+        if command == "listIndexes":
+            batch = [{"name": "_id_", "key": SON([("_id", 1)])},
+                     {"name": "community_1_number_1_unique", "unique": True,
+                      "key": SON([("community", 1.0), ("number", 1.0)])}]
+        else:
+            batch = [{"name": "response"}, {"name": "response_archive"}]
+        return {"cursor": {"id": 0, "firstBatch": batch}}
+
+
+class FakeIndexedCollection(object):
+    name = "response"
+    database = FakeCommandDatabase()
+
+
+def test_list_indexes():
+    indexes = nicoutil.list_indexes(FakeIndexedCollection())
+    assert sorted(indexes.keys()) == ["_id_", "community_1_number_1_unique"]
+    assert nicoutil.is_same_index(indexes["community_1_number_1_unique"],
+                                  [("community", 1), ("number", 1)], {"unique": True})
+    assert nicoutil.list_collection_names(FakeCommandDatabase()) == [
+        "response", "response_archive"]
+
+
+def test_metrics(tmpdir):
+    metrics = nicoutil.Metrics("test", buckets=(0.1, 1.0))
+    metrics.increment("items_total", 3, kind="bbs")
+    metrics.increment("items_total", kind="bbs")
+    metrics.observe("stage_seconds", 0.5, kind="bbs")
+
+    # the round trips are counted with the labels of the timer running in the thread
+    database = nicoutil.InstrumentedDatabase({"response": FakeCollection()}, metrics)
+    with metrics.timer("stage_seconds", kind="video"):
+        assert database.response.find_one({"a": 1}) == {"a": 1}
+    assert metrics.context() == {}
+
+    text = metrics.render()
+    assert '# TYPE test_items_total counter\ntest_items_total{kind="bbs"} 4\n' in text
+    assert 'test_stage_seconds_bucket{kind="bbs",le="0.1"} 0\n' in text
+    assert 'test_stage_seconds_bucket{kind="bbs",le="1.0"} 1\n' in text
+    assert 'test_stage_seconds_bucket{kind="bbs",le="+Inf"} 1\n' in text
+    assert 'test_stage_seconds_count{kind="video"} 1\n' in text
+    assert ('test_db_round_trips_total{collection="response",kind="video",'
+            'operation="find_one"} 1\n') in text
+
+    path = str(tmpdir.join("metrics.json"))
+    metrics.dump(path)
+    samples = json.load(open(path))["metrics"]["stage_seconds"]["samples"]
+    assert samples[0] == {"labels": {"kind": "bbs"}, "sum": 0.5, "count": 1,
+                          "buckets": {"0.1": 0, "1.0": 1, "+Inf": 1}}
+
+    server = nicoutil.serve_metrics(metrics, "127.0.0.1", 0)
+    url = "http://127.0.0.1:%d/metrics" % server.server_port
+    assert urllib.urlopen(url).read() == metrics.render()
+    assert "stage_seconds" in json.loads(urllib.urlopen(url + ".json").read())["metrics"]
+    server.shutdown()
+
+
+def test_async_handler():
+    stream = StringIO()
+    handler = nicoutil.AsyncHandler(logging.StreamHandler(stream))
+    handler.setFormatter(nicoutil.JSONFormatter())
+    logger = logging.getLogger("test_async_handler")
+    level, propagate = logger.level, logger.propagate
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+
+    nicoutil.set_log_context(lambda: {"community": "co1234", "stage": "store"})
+    try:
+        items = ["#1"]
+        logger.info("registered: %s count: %d", items, 1)
+        # the mutable arguments are formatted when the record is queued
+        items.append("#2")
+        handler.flush()
+    finally:
+        nicoutil.set_log_context(None)
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = propagate
+        handler.close()
+
+    record = json.loads(stream.getvalue())
+    assert record["message"] == "registered: ['#1'] count: 1"
+    assert record["community"] == "co1234" and record["stage"] == "store"
+    assert record["level"] == "INFO"
+
+
+def test_incomplete_storage():
+    class PageStorage(nicoutil.Storage):
+        def load_pages(self):
+            return []
+
+    try:
+        PageStorage()
+    except TypeError:
+        pass
+    else:
+        assert False, "incomplete storage is created"